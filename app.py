@@ -1,10 +1,31 @@
 import sqlite3
 import datetime
+import hashlib
+import json
+import math
+import multiprocessing
 import os
-from flask import Flask, jsonify, request, send_from_directory
+import re
+import threading
+import time
+import uuid
+import queue
+import click
+import csv
+import io
+import bisect
+import cProfile
+import pstats
+import random
+import sys
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from flask import Flask, Response, g, has_app_context, jsonify, request, send_from_directory
 from flask_cors import CORS
 from functools import wraps
 from urllib.parse import unquote
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from PIL import Image
 
@@ -14,68 +35,1383 @@ CORS(app)  # This will enable CORS for all routes
 DATABASE = 'mapconnect.db'
 UPLOAD_FOLDER = 'uploads/avatars'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+MAX_MARKERS_LIMIT = 5000
+MAX_ACTIVE_MARKERS_PER_USER = 3
+MARKER_BATCH_MAX_SIZE = 100  # Markers or ids per batch request
+SEARCH_MAX_PER_PAGE = 100
+EXPIRY_SWEEP_MAX_INTERVAL = 60  # Upper bound in seconds between two expiry sweeps
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60  # Seconds, bounds staleness for writes made by other processes
+FEED_CACHE_SIZE = 256  # Cached serialized /api/markers bodies (one per bbox/limit combination)
+FEED_CACHE_TTL = 300
+CHANGES_PAGE_SIZE = 1000  # Maximum change log entries per /api/markers/changes response
+CHANGE_LOG_TOMBSTONE_DAYS = 7  # Cursors older than this may have to resync from scratch
+CHANGE_LOG_PRUNE_INTERVAL = 3600  # Seconds
+STATS_RECONCILE_INTERVAL = 6 * 3600  # Seconds between full recomputations of the dashboard counters
+STATS_MAX_DAYS = 366  # Longest daily series /api/admin/stats returns
+IMPORT_BATCH_SIZE = 500  # Default rows per executemany/transaction for marker imports
+IMPORT_MAX_BATCH_SIZE = 10000
+IMPORT_MAX_ERRORS = 100  # Rejected rows reported back in detail
+MODERATION_CHUNK_SIZE = 500  # Markers changed per transaction by an admin bulk action
+MODERATION_MAX_CHUNK_SIZE = 5000
+ARCHIVE_RETENTION_DAYS = int(os.environ.get('MAPCONNECT_ARCHIVE_RETENTION_DAYS', 30))  # Inactive this long before archiving
+ARCHIVE_BATCH_SIZE = 500  # Markers moved to the archive per transaction
+ARCHIVE_INTERVAL = 24 * 3600  # Seconds between two archive runs, across all processes
+VACUUM_STEP_PAGES = 1000  # Free pages released per incremental_vacuum step
+ANALYZE_ROW_LIMIT = 1000  # Rows ANALYZE samples per index
+ADMIN_PAGE_SIZE = 100  # Default page size when an admin list is paginated with 'after'
+STREAM_FETCH_SIZE = 500  # Rows fetched from the cursor per streamed chunk
+CLUSTER_MAX_ZOOM = 14  # Deepest zoom level with a precomputed cluster grid
+CLUSTER_CELL_DEG_Z0 = 90.0  # Cell size at zoom 0, a quarter of a 256px web map tile
+TILE_MAX_ZOOM = 18
+TILE_MAX_MARKERS = 2000  # Markers per tile, larger tiles are truncated (use clusters at low zoom)
+TILE_CACHE_SIZE = 4096  # Tiles kept in memory
+TILE_CACHE_TTL = 300  # Seconds, bounds staleness for writes made by other processes
+TILE_MAX_AGE = 300  # Cache-Control max-age for browsers and CDNs, in seconds
+TILE_CACHE_DIR = os.environ.get('MAPCONNECT_TILE_CACHE_DIR')  # Optional on-disk tile cache layer
+AVATAR_SIZES = (64, 200, 800)  # Square renditions produced for every uploaded avatar
+AVATAR_WORKERS = int(os.environ.get('MAPCONNECT_AVATAR_WORKERS', 2))
+AVATAR_MAX_PENDING = 16  # Uploads beyond this many queued jobs are rejected with 503
+AVATAR_JOB_HISTORY = 1000  # Finished jobs kept for status polling
+AVATAR_MAX_AGE = 365 * 24 * 3600  # Content-addressed avatars never change, cache them for a year
+STREAM_QUEUE_SIZE = 256  # Pending events per live stream subscriber before it is dropped as too slow
+STREAM_HISTORY_SIZE = 4096  # Recent events kept for Last-Event-ID replay
+STREAM_HEARTBEAT_INTERVAL = 15  # Seconds between keep-alive comments on idle streams
+STREAM_RETRY_MS = 3000  # Reconnect delay suggested to EventSource clients
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get('MAPCONNECT_STREAM_MAX_SUBSCRIBERS', 5000))  # Per process
+FOLLOW_CHANGES = os.environ.get('MAPCONNECT_FOLLOW_CHANGES') == '1'  # Set when several worker processes share the DB
+HOT_SET_REFRESH_INTERVAL = 300  # Seconds between full hot set rebuilds, picking up writes made outside the app
+HOT_SET_INITIAL_CAPACITY = 1024
+EARTH_RADIUS_M = 6371008.8
+GEOHASH_PRECISION = 9  # Stored geohash length, cells of about 5 x 5 m
+NEARBY_DEFAULT_RADIUS_M = 5000
+NEARBY_MAX_RADIUS_M = 200000
+NEARBY_MAX_K = 100
+NEARBY_MAX_RINGS = 8  # Rings searched per query, the cell size is picked so the radius fits
+FOLLOW_CHANGES_INTERVAL = 1.0  # Seconds between polls of the change log for other processes' writes
+CONTENT_ADDRESSED_AVATAR = re.compile(r'^[0-9a-f]{32}_\d+\.jpg$')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+DB_POOL_SIZE = int(os.environ.get('MAPCONNECT_DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE_SIZE = 256  # Prepared statements cached per connection by sqlite3
+SLOW_QUERY_MS = float(os.environ.get('MAPCONNECT_SLOW_QUERY_MS', 100))  # Statements slower than this are logged
+PROFILE_SAMPLE_RATE = float(os.environ.get('MAPCONNECT_PROFILE_SAMPLE_RATE', 0))  # Share of requests profiled at random
+PROFILE_HISTORY = 20  # Request profiles kept for /api/admin/metrics/profiles
+METRICS_MAX_STATEMENTS = 500  # Distinct SQL statements tracked, the rest are counted as 'other'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+METRICS_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # Bytes
+METRICS_QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+RATE_LIMITING = os.environ.get('MAPCONNECT_RATE_LIMITING', '1') == '1'
+RATE_LIMIT_MAX_KEYS = 10000  # Client buckets kept per process, the least recently used are evicted
+# Per-endpoint token buckets (requests per second, burst), applied per client IP and per X-User-Username
+RATE_LIMITS = {
+    'get_markers': (5, 20),
+    'search_markers': (2, 10),
+    'get_marker_changes': (2, 10),
+    'get_marker_clusters': (10, 40),
+    'get_marker_tile': (50, 200),
+    'stream_marker_changes': (0.5, 5),
+    'login_user': (0.2, 5),
+    'register_user': (0.05, 3),
+    'add_marker': (0.5, 5),
+    'update_marker_status': (2, 10),
+    'add_markers_batch': (0.2, 3),
+    'update_markers_status_batch': (1, 5),
+    'upload_avatar': (0.1, 3),
+}
+ADMISSION_MAX_REQUESTS = int(os.environ.get('MAPCONNECT_MAX_CONCURRENT_REQUESTS', 64))  # In flight per process
+ADMISSION_MAX_WRITES = int(os.environ.get('MAPCONNECT_MAX_CONCURRENT_WRITES', 4))  # SQLite has a single writer anyway
+ADMISSION_WAIT = 0.05  # Seconds a request may wait for a free slot before it is shed
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor that reports the duration of every statement it executes to the metrics registry.
+
+    For a SELECT this is the time to the first row, rows fetched later are not included.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - started)
+
+class PooledConnection(sqlite3.Connection):
+    """A sqlite3 connection whose close() hands it back to the pool instead of closing it.
+
+    All statements run through an InstrumentedCursor so they show up in the metrics.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        db_pool.release(self)
+
+class ConnectionPool:
+    """A LIFO pool of reusable SQLite connections.
+
+    Connections are opened lazily, at most `size` idle connections are kept and any
+    extra ones are closed on release. The most recently released connection is
+    handed out first, so the auth decorator and the view of one request end up
+    sharing a single physical connection.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.opened = 0
+        self.closed = 0
+        self.acquired = 0
+        self.reused = 0
+        self._leases = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            DATABASE,
+            factory=PooledConnection,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+        conn.db_path = DATABASE
+        # Only takes effect on a new database, lets the archiving job release free pages
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        # WAL lets readers proceed while a writer holds the lock
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -8000')  # 8 MB page cache
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections must not be shared with a forked parent process
+                self._idle = []
+                self._pid = os.getpid()
+                self.in_use = 0
+            conn = None
+            while self._idle:
+                candidate = self._idle.pop()
+                if candidate.db_path == DATABASE:
+                    conn = candidate
+                    self.reused += 1
+                    break
+                self._close(candidate)
+            self.in_use += 1
+            self.acquired += 1
+            self._leases += 1
+            lease = self._leases
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self.in_use -= 1
+                raise
+            with self._lock:
+                self.opened += 1
+        conn.pool_lease = lease
+        return conn
+
+    def release(self, conn, lease=None):
+        """Returns a connection to the pool. If lease is given, only that checkout is released."""
+        current_lease = getattr(conn, 'pool_lease', None)
+        if current_lease is None or (lease is not None and lease != current_lease):
+            return  # Already released, possibly re-acquired by someone else since
+        conn.pool_lease = None
+        try:
+            if conn.in_transaction:
+                conn.rollback()  # Never hand out a connection with uncommitted work
+            reusable = True
+        except sqlite3.Error:
+            reusable = False
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+            if reusable and len(self._idle) < self.size and conn.db_path == DATABASE:
+                self._idle.append(conn)
+                return
+            self._close(conn)
+
+    def _close(self, conn):
+        sqlite3.Connection.close(conn)
+        self.closed += 1
+
+    def close_all(self):
+        """Closes every idle connection, e.g. after switching DATABASE."""
+        with self._lock:
+            while self._idle:
+                self._close(self._idle.pop())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'opened': self.opened,
+                'closed': self.closed,
+                'acquired': self.acquired,
+                'reused': self.reused,
+            }
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+
 def get_db_connection():
-    """Creates a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+    """Gets a pooled database connection. Call close() to return it to the pool."""
+    conn = db_pool.acquire()
+    if has_app_context():
+        g.setdefault('db_connections', []).append((conn, conn.pool_lease))
     return conn
 
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    """Returns connections that a request forgot to close (e.g. on an exception) to the pool."""
+    for conn, lease in g.pop('db_connections', []):
+        db_pool.release(conn, lease)
+
+# --- Metrics ---
+
+class Histogram:
+    """A Prometheus-style histogram with fixed bucket upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def prometheus_labels(**labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+class MetricsRegistry:
+    """Per-endpoint request metrics and per-statement query timings, rendered as Prometheus text.
+
+    Requests are labelled with their Flask endpoint name, so the number of series is
+    bounded by the number of routes. Statements are keyed by their whitespace-normalized
+    SQL. Queries run outside a request (background threads, streamed bodies) are only
+    counted per statement.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.latency = {}  # (endpoint, method) -> Histogram of seconds
+        self.response_size = {}  # endpoint -> Histogram of bytes
+        self.request_queries = {}  # endpoint -> Histogram of queries per request
+        self.statements = {}  # sql -> [count, total seconds, max seconds]
+        self.slow_queries = 0
+        self.profiles = OrderedDict()  # id -> profile report
+
+    def observe_request(self, endpoint, method, status, seconds, size, queries):
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault((endpoint, method), Histogram(METRICS_LATENCY_BUCKETS)).observe(seconds)
+            if size is not None:
+                self.response_size.setdefault(endpoint, Histogram(METRICS_SIZE_BUCKETS)).observe(size)
+            self.request_queries.setdefault(endpoint, Histogram(METRICS_QUERY_COUNT_BUCKETS)).observe(queries)
+
+    def observe_query(self, sql, seconds):
+        if has_app_context():
+            g.query_count = g.get('query_count', 0) + 1
+        statement = ' '.join(sql.split())
+        with self._lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                if len(self.statements) >= METRICS_MAX_STATEMENTS:
+                    statement = 'other'
+                entry = self.statements.setdefault(statement, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                self.slow_queries += 1
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            print(f"Slow query ({seconds * 1000:.1f} ms): {statement[:500]}")
+
+    def add_profile(self, report):
+        profile_id = uuid.uuid4().hex[:12]
+        with self._lock:
+            self.profiles[profile_id] = report
+            while len(self.profiles) > PROFILE_HISTORY:
+                self.profiles.popitem(last=False)
+        return profile_id
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def histogram(name, help_text, series):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, hist in series:
+                cumulative = 0
+                for bound, count in zip(list(hist.buckets) + ['+Inf'], hist.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{prometheus_labels(**labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_sum{prometheus_labels(**labels)} {hist.sum}')
+                lines.append(f'{name}_count{prometheus_labels(**labels)} {hist.count}')
+
+        def simple(name, metric_type, help_text, series):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in series:
+                lines.append(f'{name}{prometheus_labels(**labels)} {value}')
+
+        with self._lock:
+            simple('mapconnect_http_requests_total', 'counter', 'HTTP requests by endpoint, method and status.', [
+                ({'endpoint': e, 'method': m, 'status': s}, n) for (e, m, s), n in sorted(self.requests.items())
+            ])
+            histogram('mapconnect_http_request_duration_seconds', 'Time spent in the view, excluding streamed bodies.', [
+                ({'endpoint': e, 'method': m}, h) for (e, m), h in sorted(self.latency.items())
+            ])
+            histogram('mapconnect_http_response_size_bytes', 'Response body sizes (streamed bodies are not counted).', [
+                ({'endpoint': e}, h) for e, h in sorted(self.response_size.items())
+            ])
+            histogram('mapconnect_http_request_db_queries', 'SQL statements executed per request.', [
+                ({'endpoint': e}, h) for e, h in sorted(self.request_queries.items())
+            ])
+            statements = sorted(self.statements.items())
+            simple('mapconnect_db_queries_total', 'counter', 'SQL statements executed.', [
+                ({'statement': sql}, entry[0]) for sql, entry in statements
+            ])
+            simple('mapconnect_db_query_seconds_total', 'counter', 'Time spent executing SQL statements.', [
+                ({'statement': sql}, entry[1]) for sql, entry in statements
+            ])
+            simple('mapconnect_db_query_max_seconds', 'gauge', 'Slowest execution of each SQL statement.', [
+                ({'statement': sql}, entry[2]) for sql, entry in statements
+            ])
+            simple('mapconnect_db_slow_queries_total', 'counter', f'SQL statements slower than {SLOW_QUERY_MS} ms.', [
+                ({}, self.slow_queries)
+            ])
+
+        pool = db_pool.stats()
+        simple('mapconnect_db_pool_connections', 'gauge', 'Pooled database connections by state.', [
+            ({'state': 'in_use'}, pool['in_use']), ({'state': 'idle'}, pool['idle'])
+        ])
+        caches = [('user', user_cache), ('marker_feed', marker_feed_cache), ('tile', tile_cache)]
+        cache_stats = [(name, cache.stats()) for name, cache in caches]
+        simple('mapconnect_cache_hits_total', 'counter', 'In-process cache hits.', [
+            ({'cache': name}, stats['hits']) for name, stats in cache_stats
+        ])
+        simple('mapconnect_cache_misses_total', 'counter', 'In-process cache misses.', [
+            ({'cache': name}, stats['misses']) for name, stats in cache_stats
+        ])
+        simple('mapconnect_rate_limited_total', 'counter', 'Requests rejected by the rate limiter.', [
+            ({'endpoint': endpoint}, count) for endpoint, count in sorted(rate_limiter.stats()['limited'].items())
+        ])
+        admission_stats = admission.stats()
+        simple('mapconnect_requests_shed_total', 'counter', 'Requests shed by admission control.', [
+            ({}, admission_stats['shed'])
+        ])
+        simple('mapconnect_requests_in_flight', 'gauge', 'Requests being served by this process.', [
+            ({}, admission_stats['in_flight'])
+        ])
+        simple('mapconnect_stream_subscribers', 'gauge', 'Connected live marker stream clients.', [
+            ({}, marker_events.stats()['subscribers'])
+        ])
+        simple('mapconnect_avatar_jobs_pending', 'gauge', 'Queued or running avatar processing jobs.', [
+            ({}, avatar_jobs.stats()['queue_depth'])
+        ])
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+@app.before_request
+def start_request_metrics():
+    """Starts timing the request, and profiles it if sampled or asked to by an admin."""
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    profile = PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not profile and request.headers.get('X-Profile') and request.headers.get('X-Admin-Username'):
+        admin = get_cached_user(request.headers['X-Admin-Username'])
+        profile = admin is not None and admin['role'] == 'admin'
+    if profile:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+# --- Rate Limiting ---
+
+class TokenBucketLimiter:
+    """Token buckets per (endpoint, client key), kept in a bounded LRU.
+
+    An evicted bucket comes back full, which is what an idle client's bucket would
+    have refilled to anyway, so eviction only forgets clients that went quiet.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> [tokens, last refill time]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = {}  # endpoint -> rejected requests
+        self.evictions = 0
+
+    def take(self, endpoint, key, rate, burst):
+        """Takes a token from the bucket. Returns 0 if allowed, else the seconds until one is available."""
+        now = time.monotonic()
+        bucket_key = (endpoint, key)
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = [burst, now]
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(bucket_key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed += 1
+                return 0
+            self.limited[endpoint] = self.limited.get(endpoint, 0) + 1
+            return (1 - bucket[0]) / rate
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._buckets),
+                'maxsize': self.maxsize,
+                'allowed': self.allowed,
+                'limited': dict(self.limited),
+                'evictions': self.evictions,
+            }
+
+class AdmissionController:
+    """Caps the requests (and, separately, the writes) in flight in this process.
+
+    A request that finds no free slot within ADMISSION_WAIT seconds is shed with a 503
+    instead of queueing behind a busy SQLite writer and slowing everyone down.
+    """
+
+    def __init__(self, max_requests, max_writes):
+        self.max_requests = max_requests
+        self.max_writes = max_writes
+        self._requests = threading.Semaphore(max_requests)
+        self._writes = threading.Semaphore(max_writes)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.shed = 0
+
+    def enter(self, is_write):
+        """Returns the slots taken for this request, or None if it has to be shed."""
+        if not self._requests.acquire(timeout=ADMISSION_WAIT):
+            slots = None
+        elif is_write and not self._writes.acquire(timeout=ADMISSION_WAIT):
+            self._requests.release()
+            slots = None
+        else:
+            slots = (self._requests, self._writes) if is_write else (self._requests,)
+        with self._lock:
+            if slots is None:
+                self.shed += 1
+            else:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return slots
+
+    def leave(self, slots):
+        for semaphore in slots:
+            semaphore.release()
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_requests': self.max_requests,
+                'max_writes': self.max_writes,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'shed': self.shed,
+            }
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_MAX_KEYS)
+admission = AdmissionController(ADMISSION_MAX_REQUESTS, ADMISSION_MAX_WRITES)
+
+def too_many_requests(message, status, retry_after):
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@app.before_request
+def limit_request_rate():
+    """Applies the per-client rate limits of RATE_LIMITS, then admission control."""
+    if not RATE_LIMITING or request.method == 'OPTIONS':
+        return None
+    limit = RATE_LIMITS.get(request.endpoint)
+    if limit is not None:
+        # Behind a reverse proxy, wrap the app in werkzeug's ProxyFix so remote_addr is the client
+        keys = [f'ip:{request.remote_addr}']
+        if request.headers.get('X-User-Username'):
+            keys.append(f"user:{request.headers['X-User-Username']}")
+        for key in keys:
+            retry_after = rate_limiter.take(request.endpoint, key, *limit)
+            if retry_after:
+                return too_many_requests('Too many requests, slow down', 429, retry_after)
+
+    slots = admission.enter(request.method in ('POST', 'PUT', 'PATCH', 'DELETE'))
+    if slots is None:
+        return too_many_requests('Server is busy, try again shortly', 503, 1)
+    g.admission_slots = slots
+    return None
+
+@app.teardown_request
+def release_admission_slots(exception=None):
+    slots = g.pop('admission_slots', None)
+    if slots is not None:
+        admission.leave(slots)
+
+@app.after_request
+def record_request_metrics(response):
+    """Records latency, status, response size and query count of the finished request."""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        report = io.StringIO()
+        report.write(f'{request.method} {request.full_path}\n\n')
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+        response.headers['X-Profile-Id'] = metrics.add_profile(report.getvalue())
+    metrics.observe_request(
+        request.endpoint or 'unmatched', request.method, response.status_code,
+        time.perf_counter() - started,
+        None if response.is_streamed else response.calculate_content_length(),
+        g.get('query_count', 0)
+    )
+    return response
+
+def migrate_base_schema(conn):
+    """Creates the markers and users tables."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS markers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            contact TEXT,
+            marker_type TEXT NOT NULL,
+            visibility TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lng REAL NOT NULL,
+            user_username TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP,
+            status TEXT NOT NULL DEFAULT 'active'
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT,
+            contact TEXT,
+            bio TEXT,
+            gender TEXT DEFAULT 'secret',
+            age INTEGER,
+            role TEXT NOT NULL DEFAULT 'user',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            avatar_url TEXT
+        )
+    ''')
+    
+    # Simple migration: rename phone to contact if it exists
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'phone' in columns and 'contact' not in columns:
+        conn.execute('ALTER TABLE users RENAME COLUMN phone TO contact;')
+        print("Migrated 'users' table: renamed 'phone' to 'contact'.")
+
+    # Add avatar_url column to users table if it doesn't exist for backward compatibility
+    if 'avatar_url' not in columns:
+        conn.execute('ALTER TABLE users ADD COLUMN avatar_url TEXT')
+        print("Added 'avatar_url' column to 'users' table.")
+
+def migrate_spatial_index(conn):
+    """Adds the markers_rtree spatial index."""
+    # Spatial index for viewport queries. Only active markers are indexed,
+    # the triggers below keep it in sync with inserts, status changes and deletes.
+    rtree_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'markers_rtree'"
+    ).fetchone()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS markers_rtree USING rtree(
+            id, min_lng, max_lng, min_lat, max_lat
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_rtree_ai AFTER INSERT ON markers
+        WHEN NEW.status = 'active'
+        BEGIN
+            INSERT OR REPLACE INTO markers_rtree VALUES (NEW.id, NEW.lng, NEW.lng, NEW.lat, NEW.lat);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_rtree_au AFTER UPDATE OF status, lat, lng ON markers
+        BEGIN
+            DELETE FROM markers_rtree WHERE id = OLD.id;
+            INSERT INTO markers_rtree
+                SELECT NEW.id, NEW.lng, NEW.lng, NEW.lat, NEW.lat WHERE NEW.status = 'active';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_rtree_ad AFTER DELETE ON markers
+        BEGIN
+            DELETE FROM markers_rtree WHERE id = OLD.id;
+        END
+    ''')
+    if not rtree_exists:
+        conn.execute('''
+            INSERT INTO markers_rtree
+            SELECT id, lng, lng, lat, lat FROM markers WHERE status = 'active'
+        ''')
+        print("Created 'markers_rtree' spatial index for active markers.")
+
+def migrate_full_text_index(conn):
+    """Adds the markers_fts full-text index."""
+    # Full-text index over the searchable marker fields. The trigram tokenizer gives
+    # substring matching, which also works for CJK text without word boundaries.
+    fts_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'markers_fts'"
+    ).fetchone()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS markers_fts USING fts5(
+            title, description, contact,
+            content = 'markers', content_rowid = 'id', tokenize = 'trigram'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_fts_ai AFTER INSERT ON markers
+        BEGIN
+            INSERT INTO markers_fts(rowid, title, description, contact)
+            VALUES (NEW.id, NEW.title, NEW.description, NEW.contact);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_fts_au AFTER UPDATE OF title, description, contact ON markers
+        BEGIN
+            INSERT INTO markers_fts(markers_fts, rowid, title, description, contact)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description, OLD.contact);
+            INSERT INTO markers_fts(rowid, title, description, contact)
+            VALUES (NEW.id, NEW.title, NEW.description, NEW.contact);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS markers_fts_ad AFTER DELETE ON markers
+        BEGIN
+            INSERT INTO markers_fts(markers_fts, rowid, title, description, contact)
+            VALUES ('delete', OLD.id, OLD.title, OLD.description, OLD.contact);
+        END
+    ''')
+    if not fts_exists:
+        conn.execute("INSERT INTO markers_fts(markers_fts) VALUES ('rebuild')")
+        print("Created 'markers_fts' full-text index for markers.")
+
+def migrate_change_log(conn):
+    """Adds the marker_changes log for delta sync and the app_meta table."""
+    # Change log for delta sync. Each marker keeps only its latest entry, so the log
+    # grows with the number of markers rather than the number of writes. Deletes
+    # leave a tombstone that is pruned after CHANGE_LOG_TOMBSTONE_DAYS.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS marker_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            marker_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_marker_changes_marker_id ON marker_changes(marker_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS app_meta (
+            key TEXT PRIMARY KEY,
+            value
+        )
+    ''')
+    for trigger_name, event, row, op in [
+        ('marker_changes_ai', 'INSERT', 'NEW', 'upsert'),
+        ('marker_changes_au', 'UPDATE', 'NEW', 'upsert'),
+        ('marker_changes_ad', 'DELETE', 'OLD', 'delete'),
+    ]:
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {trigger_name} AFTER {event} ON markers
+            BEGIN
+                DELETE FROM marker_changes WHERE marker_id = {row}.id;
+                INSERT INTO marker_changes (marker_id, op) VALUES ({row}.id, '{op}');
+            END
+        ''')
+    # user_name is part of the synced marker, so a rename touches all of the user's markers
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS marker_changes_user_name_au AFTER UPDATE OF name ON users
+        WHEN OLD.name IS NOT NEW.name
+        BEGIN
+            DELETE FROM marker_changes
+            WHERE marker_id IN (SELECT id FROM markers WHERE user_username = NEW.username);
+            INSERT INTO marker_changes (marker_id, op)
+            SELECT id, 'upsert' FROM markers WHERE user_username = NEW.username;
+        END
+    ''')
+
+def migrate_hot_query_indexes(conn):
+    """Adds the secondary indexes used by the hot queries (see HOT_QUERIES)."""
+    # get_markers, the expiry sweep and the next-expiry lookup filter on (status, expires_at)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_status_expires_at ON markers(status, expires_at)')
+    # Expired-marker counting for the dashboard is a range over expires_at alone
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_expires_at ON markers(expires_at)')
+    # add_marker's active marker limit, get_user_markers and the admin_delete_user cascade
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_user_status ON markers(user_username, status)')
+    # Admin lists are ordered and keyset-paginated by (created_at, id)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_created_at ON markers(created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at, id)')
+    # Tombstone pruning
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_marker_changes_op_changed_at ON marker_changes(op, changed_at)')
+
+def migrate_marker_geohash(conn):
+    """Adds the markers.geohash column and its index for nearby searches."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(markers)')]
+    if 'geohash' not in columns:
+        conn.execute('ALTER TABLE markers ADD COLUMN geohash TEXT')
+    rows = conn.execute('SELECT id, lat, lng FROM markers WHERE geohash IS NULL').fetchall()
+    conn.executemany(
+        'UPDATE markers SET geohash = ? WHERE id = ?',
+        ((geohash_encode(row['lat'], row['lng']), row['id']) for row in rows)
+    )
+    # Partial index: nearby searches only look at active markers (queries must say status = 'active' literally)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_markers_geohash_active ON markers(geohash) WHERE status = 'active'")
+    print(f"Computed geohashes for {len(rows)} markers.")
+
+class TTLCache:
+    """A thread-safe, size-bounded LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default on a miss."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+_CACHE_MISS = object()
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+marker_feed_cache = TTLCache(FEED_CACHE_SIZE, FEED_CACHE_TTL)
+tile_cache = TTLCache(TILE_CACHE_SIZE, TILE_CACHE_TTL)
+
+def get_cached_user(username):
+    """Looks up a user (without password) through user_cache. Unknown users are cached as None."""
+    user = user_cache.get(username, _CACHE_MISS)
+    if user is not _CACHE_MISS:
+        return user
+    conn = get_db_connection()
+    row = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    conn.close()
+    user = None
+    if row:
+        user = dict(row)
+        del user['password']
+    user_cache.set(username, user)
+    return user
+
+def invalidate_cached_user(username):
+    """Drops a user from user_cache. Must be called by every endpoint that changes a user."""
+    user_cache.invalidate(username)
+
+class DataVersion:
+    """A thread-safe, monotonically increasing version counter."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+            return self.value
+
+marker_data_version = DataVersion()
+marker_change_listeners = []
+
+def on_marker_change(listener):
+    """Decorator registering listener(kind, markers) to be called after every marker write."""
+    marker_change_listeners.append(listener)
+    return listener
+
+def notify_marker_change(kind, markers, local=True):
+    """Bumps the marker data version and notifies listeners. Call after the write is committed.
+
+    kind is one of 'created', 'status', 'updated', 'deleted' or 'expired' and markers is
+    a list of the affected rows as dicts (their last state for deletes). Changes made
+    by another process are replayed with local=False; a marker deleted there only
+    carries its 'id'.
+    """
+    if local and FOLLOW_CHANGES:
+        change_follower.remember(markers)
+    marker_data_version.bump()
+    for listener in marker_change_listeners:
+        try:
+            listener(kind, markers)
+        except Exception as e:
+            print(f"Marker change listener {listener.__name__} failed: {e}")
+
+def migrate_marker_archive(conn):
+    """Adds the markers_archive table that archive_markers moves long-inactive markers into."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS markers_archive (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT NOT NULL,
+            contact TEXT,
+            marker_type TEXT NOT NULL,
+            visibility TEXT NOT NULL,
+            lat REAL NOT NULL,
+            lng REAL NOT NULL,
+            user_username TEXT NOT NULL,
+            created_at TIMESTAMP,
+            expires_at TIMESTAMP,
+            status TEXT NOT NULL,
+            geohash TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # The admin archive list is keyset-paginated like the other admin lists
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_archive_created_at ON markers_archive(created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_markers_archive_user ON markers_archive(user_username)')
+    # Archived markers keep counting towards the dashboard totals: moving a marker
+    # adds it back here what deleting it from markers subtracted
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_markers_archive_ai AFTER INSERT ON markers_archive
+        BEGIN {marker_stat_counters('NEW', 1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_markers_archive_ad AFTER DELETE ON markers_archive
+        BEGIN {marker_stat_counters('OLD', -1)} END
+    ''')
+
+def migrate_change_log_kinds(conn):
+    """Records the kind of every marker_changes entry, and the deleted row in tombstones."""
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(marker_changes)')]
+    if 'kind' not in columns:
+        conn.execute('ALTER TABLE marker_changes ADD COLUMN kind TEXT')
+    if 'snapshot' not in columns:
+        conn.execute('ALTER TABLE marker_changes ADD COLUMN snapshot TEXT')
+    # The kinds of notify_marker_change, so other workers replay the same events. They are
+    # derived from the row: a deactivation past expires_at is 'expired', a change of the
+    # status alone is 'status'.
+    marker_columns = [
+        'id', 'title', 'description', 'contact', 'marker_type', 'visibility',
+        'lat', 'lng', 'user_username', 'created_at', 'expires_at', 'status', 'geohash'
+    ]
+    status_only = ' AND '.join(
+        f'NEW.{c} IS OLD.{c}' for c in marker_columns if c not in ('id', 'status')
+    )
+    update_kind = f"""
+        CASE
+            WHEN OLD.status = 'active' AND NEW.status = 'inactive'
+                 AND NEW.expires_at <= strftime('%Y-%m-%d %H:%M:%f+00:00', 'now') THEN 'expired'
+            WHEN NEW.status IS NOT OLD.status AND {status_only} THEN 'status'
+            ELSE 'updated'
+        END
+    """
+    snapshot = 'json_object(' + ', '.join(f"'{c}', OLD.{c}" for c in marker_columns) + ')'
+    for trigger_name, event, row, op, kind, row_snapshot in [
+        ('marker_changes_ai', 'INSERT', 'NEW', 'upsert', "'created'", 'NULL'),
+        ('marker_changes_au', 'UPDATE', 'NEW', 'upsert', update_kind, 'NULL'),
+        ('marker_changes_ad', 'DELETE', 'OLD', 'delete', "'deleted'", snapshot),
+    ]:
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger_name}')
+        conn.execute(f'''
+            CREATE TRIGGER {trigger_name} AFTER {event} ON markers
+            BEGIN
+                DELETE FROM marker_changes WHERE marker_id = {row}.id;
+                INSERT INTO marker_changes (marker_id, op, kind, snapshot)
+                VALUES ({row}.id, '{op}', {kind}, {row_snapshot});
+            END
+        ''')
+    conn.execute('DROP TRIGGER IF EXISTS marker_changes_user_name_au')
+    conn.execute('''
+        CREATE TRIGGER marker_changes_user_name_au AFTER UPDATE OF name ON users
+        WHEN OLD.name IS NOT NEW.name
+        BEGIN
+            DELETE FROM marker_changes
+            WHERE marker_id IN (SELECT id FROM markers WHERE user_username = NEW.username);
+            INSERT INTO marker_changes (marker_id, op, kind)
+            SELECT id, 'upsert', 'updated' FROM markers WHERE user_username = NEW.username;
+        END
+    ''')
+
+def migrate_marker_clusters(conn):
+    """Adds the precomputed cluster grid and the triggers that maintain it.
+
+    marker_clusters holds, per zoom level, grid cell and marker_type, the count and
+    coordinate sums of the active markers in the cell. At zoom z a cell spans
+    CLUSTER_CELL_DEG_Z0 / 2**z degrees. The grid itself is filled by sync_cluster_zooms.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_zooms (
+            zoom INTEGER PRIMARY KEY,
+            cell_deg REAL NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS marker_clusters (
+            zoom INTEGER NOT NULL,
+            cell_x INTEGER NOT NULL,
+            cell_y INTEGER NOT NULL,
+            marker_type TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            sum_lat REAL NOT NULL,
+            sum_lng REAL NOT NULL,
+            PRIMARY KEY (zoom, cell_x, cell_y, marker_type)
+        ) WITHOUT ROWID
+    ''')
+
+    # SQL fragments locating the cells of a marker row (NEW or OLD) on every zoom level
+    def cells_of(row):
+        return f'''
+            SELECT z.zoom, CAST(({row}.lng + 180) / z.cell_deg AS INTEGER) AS cell_x,
+                   CAST(({row}.lat + 90) / z.cell_deg AS INTEGER) AS cell_y
+            FROM cluster_zooms z
+        '''
+
+    def add(row):
+        return f'''
+            INSERT INTO marker_clusters (zoom, cell_x, cell_y, marker_type, count, sum_lat, sum_lng)
+            SELECT c.zoom, c.cell_x, c.cell_y, {row}.marker_type, 1, {row}.lat, {row}.lng
+            FROM ({cells_of(row)}) c
+            WHERE {row}.status = 'active'
+            ON CONFLICT (zoom, cell_x, cell_y, marker_type) DO UPDATE SET
+                count = count + 1, sum_lat = sum_lat + excluded.sum_lat, sum_lng = sum_lng + excluded.sum_lng;
+        '''
+
+    def subtract(row):
+        return f'''
+            UPDATE marker_clusters
+            SET count = count - 1, sum_lat = sum_lat - {row}.lat, sum_lng = sum_lng - {row}.lng
+            WHERE {row}.status = 'active' AND marker_type = {row}.marker_type
+              AND (zoom, cell_x, cell_y) IN ({cells_of(row)});
+            DELETE FROM marker_clusters
+            WHERE count <= 0 AND marker_type = {row}.marker_type
+              AND (zoom, cell_x, cell_y) IN ({cells_of(row)});
+        '''
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS marker_clusters_ai AFTER INSERT ON markers
+        BEGIN {add('NEW')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS marker_clusters_au AFTER UPDATE OF status, lat, lng, marker_type ON markers
+        BEGIN {subtract('OLD')} {add('NEW')} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS marker_clusters_ad AFTER DELETE ON markers
+        BEGIN {subtract('OLD')} END
+    ''')
+
+def sync_cluster_zooms(conn):
+    """Rebuilds the cluster grid if the configured zoom levels changed since it was built."""
+    zooms = [(z, CLUSTER_CELL_DEG_Z0 / 2 ** z) for z in range(CLUSTER_MAX_ZOOM + 1)]
+    if [tuple(row) for row in conn.execute('SELECT zoom, cell_deg FROM cluster_zooms ORDER BY zoom')] != zooms:
+        conn.execute('DELETE FROM cluster_zooms')
+        conn.executemany('INSERT INTO cluster_zooms (zoom, cell_deg) VALUES (?, ?)', zooms)
+        conn.execute('DELETE FROM marker_clusters')
+        conn.execute('''
+            INSERT INTO marker_clusters (zoom, cell_x, cell_y, marker_type, count, sum_lat, sum_lng)
+            SELECT z.zoom, CAST((m.lng + 180) / z.cell_deg AS INTEGER), CAST((m.lat + 90) / z.cell_deg AS INTEGER),
+                   m.marker_type, COUNT(*), SUM(m.lat), SUM(m.lng)
+            FROM markers m, cluster_zooms z
+            WHERE m.status = 'active'
+            GROUP BY 1, 2, 3, 4
+        ''')
+        print(f"Built 'marker_clusters' grid for zoom levels 0-{CLUSTER_MAX_ZOOM}.")
+
+def stat_counter_bump(name, delta, condition='1'):
+    """Returns the trigger statement adding delta to the stat counter named by the SQL expression name."""
+    return f'''
+        INSERT INTO stat_counters (name, value) SELECT {name}, {delta} WHERE {condition}
+        ON CONFLICT (name) DO UPDATE SET value = value + excluded.value;
+    '''
+
+def marker_stat_counters(row, delta):
+    """Returns the trigger statements adding delta to every dashboard counter of the marker row (NEW or OLD)."""
+    watermark = "(SELECT value FROM app_meta WHERE key = 'expired_watermark')"
+    return (
+        stat_counter_bump("'markers_total'", delta)
+        + stat_counter_bump(f"'markers_type:' || {row}.marker_type", delta)
+        + stat_counter_bump(f"'markers_status:' || {row}.status", delta)
+        + stat_counter_bump("'markers_expired'", delta, f'{row}.expires_at <= {watermark}')
+        + f'''
+            INSERT INTO marker_daily_stats (day, created) VALUES (date({row}.created_at), {delta})
+            ON CONFLICT (day) DO UPDATE SET created = created + excluded.created;
+        '''
+    )
+
+def migrate_stat_counters(conn):
+    """Adds the admin dashboard counters and the triggers that keep them current.
+
+    stat_counters holds running totals ('markers_total', 'users_total', 'markers_expired',
+    'markers_type:<type>', 'markers_status:<status>') and marker_daily_stats the markers
+    created per UTC day. 'markers_expired' counts markers with expires_at up to the
+    'expired_watermark' in app_meta, which the expiry scheduler advances. Counters are
+    rebuilt from scratch by reconcile_stat_counters.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stat_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS marker_daily_stats (
+            day TEXT PRIMARY KEY,
+            created INTEGER NOT NULL
+        )
+    ''')
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_markers_ai AFTER INSERT ON markers
+        BEGIN {marker_stat_counters('NEW', 1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_markers_ad AFTER DELETE ON markers
+        BEGIN {marker_stat_counters('OLD', -1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_markers_au
+        AFTER UPDATE OF status, marker_type, expires_at, created_at ON markers
+        BEGIN {marker_stat_counters('OLD', -1)} {marker_stat_counters('NEW', 1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_users_ai AFTER INSERT ON users
+        BEGIN {stat_counter_bump("'users_total'", 1)} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS stat_counters_users_ad AFTER DELETE ON users
+        BEGIN {stat_counter_bump("'users_total'", -1)} END
+    ''')
+
+    reconcile_stat_counters(conn)
+
+def reconcile_stat_counters(conn):
+    """Recomputes every dashboard counter from the markers and users tables.
+
+    Runs inside the caller's transaction, so the counters never appear half rebuilt.
+    Archived markers count as well.
+    """
+    now = datetime.datetime.now(datetime.UTC)
+    all_markers = 'markers'
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'markers_archive'").fetchone():
+        columns = 'marker_type, status, created_at, expires_at'
+        all_markers = f'(SELECT {columns} FROM markers UNION ALL SELECT {columns} FROM markers_archive)'
+    conn.execute('DELETE FROM stat_counters')
+    conn.execute('DELETE FROM marker_daily_stats')
+    conn.execute('''
+        INSERT INTO app_meta (key, value) VALUES ('expired_watermark', ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    ''', (now,))
+    conn.execute(f'''
+        INSERT INTO stat_counters (name, value)
+        SELECT 'markers_total', COUNT(*) FROM {all_markers}
+        UNION ALL SELECT 'users_total', COUNT(*) FROM users
+        UNION ALL SELECT 'markers_expired', COUNT(*) FROM {all_markers} WHERE expires_at <= ?
+        UNION ALL SELECT 'markers_type:' || marker_type, COUNT(*) FROM {all_markers} GROUP BY marker_type
+        UNION ALL SELECT 'markers_status:' || status, COUNT(*) FROM {all_markers} GROUP BY status
+    ''', (now,))
+    conn.execute(f'''
+        INSERT INTO marker_daily_stats (day, created)
+        SELECT date(created_at), COUNT(*) FROM {all_markers} GROUP BY date(created_at)
+    ''')
+
+def advance_expired_counter():
+    """Moves the 'markers_expired' watermark to now, counting the markers that expired since."""
+    now = datetime.datetime.now(datetime.UTC)
+    conn = get_db_connection()
+    with conn:
+        conn.execute('''
+            UPDATE stat_counters
+            SET value = value + (
+                SELECT COUNT(*) FROM markers
+                WHERE expires_at > (SELECT value FROM app_meta WHERE key = 'expired_watermark') AND expires_at <= ?
+            )
+            WHERE name = 'markers_expired'
+        ''', (now,))
+        conn.execute("UPDATE app_meta SET value = ? WHERE key = 'expired_watermark'", (now,))
+    conn.close()
+
+# Schema migrations, applied in order. PRAGMA user_version records how many have run.
+# Never edit or reorder a released migration, append a new one instead.
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_spatial_index,
+    migrate_full_text_index,
+    migrate_change_log,
+    migrate_marker_clusters,
+    migrate_stat_counters,
+    migrate_hot_query_indexes,
+    migrate_marker_geohash,
+    migrate_marker_archive,
+    migrate_change_log_kinds,
+]
+
+# Queries run verbatim by the endpoints and checked by HOT_QUERIES
+USER_MARKERS_QUERY = '''
+    SELECT m.*, u.name as user_name
+    FROM markers m
+    JOIN users u ON m.user_username = u.username
+    WHERE m.user_username = ? ORDER BY m.created_at DESC
+'''
+ACTIVE_MARKER_COUNT_QUERY = 'SELECT COUNT(*) FROM markers WHERE user_username = ? AND status = ?'
+LOGIN_QUERY = 'SELECT * FROM users WHERE (username = ? OR email = ?) AND password = ?'
+NEXT_EXPIRY_QUERY = "SELECT MIN(expires_at) FROM markers WHERE status = 'active'"
+MARKER_CHANGES_QUERY = 'SELECT seq, marker_id, op FROM marker_changes WHERE seq > ? ORDER BY seq LIMIT ?'
+CLUSTER_CELLS_QUERY = '''
+    SELECT cell_x, cell_y, marker_type, count, sum_lat, sum_lng
+    FROM marker_clusters
+    WHERE zoom = ? AND cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?
+'''
+ARCHIVE_CANDIDATES_QUERY = '''
+    SELECT id FROM markers
+    WHERE status = 'inactive' AND (
+        expires_at <= ?
+        OR id IN (SELECT marker_id FROM marker_changes WHERE op = 'upsert' AND changed_at <= ?)
+    )
+    LIMIT ?
+'''
+
+def search_marker_queries(terms, marker_type, now):
+    """Builds the count and page queries of search_markers, returns (count_query, page_query, params).
+
+    The page query takes LIMIT and OFFSET after params.
+    """
+    # The trigram index can only match terms of 3+ characters, shorter terms
+    # are applied as substring filters on the FTS candidates (or active markers).
+    fts_terms = [t for t in terms if len(t) >= 3]
+    like_terms = [t for t in terms if len(t) < 3]
+
+    where = ['m.expires_at > ?', 'm.status = ?']
+    params = [now, 'active']
+    for term in like_terms:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where.append("(m.title LIKE ? ESCAPE '\\' OR m.description LIKE ? ESCAPE '\\' OR m.contact LIKE ? ESCAPE '\\')")
+        params.extend([pattern, pattern, pattern])
+    if marker_type:
+        where.append('m.marker_type = ?')
+        params.append(marker_type)
+
+    if fts_terms:
+        match_query = ' AND '.join('"' + t.replace('"', '""') + '"' for t in fts_terms)
+        # CROSS JOIN keeps the FTS index driving the join, otherwise SQLite may scan the
+        # active markers and re-run the MATCH for each of them
+        from_clause = 'markers_fts CROSS JOIN markers m ON m.id = markers_fts.rowid'
+        where.insert(0, 'markers_fts MATCH ?')
+        params.insert(0, match_query)
+        # Matches in the title weigh more than the description, contact weighs least
+        rank_column = 'bm25(markers_fts, 10.0, 5.0, 1.0)'
+        order_by = 'rank, m.created_at DESC'
+    else:
+        from_clause = 'markers m'
+        rank_column = 'NULL'
+        order_by = 'm.created_at DESC'
+    where_clause = ' AND '.join(where)
+
+    count_query = f'SELECT COUNT(*) FROM {from_clause} WHERE {where_clause}'
+    page_query = f'''
+        SELECT m.*, u.name as user_name, {rank_column} as rank
+        FROM {from_clause}
+        JOIN users u ON m.user_username = u.username
+        WHERE {where_clause}
+        ORDER BY {order_by}
+        LIMIT ? OFFSET ?
+    '''
+    return count_query, page_query, tuple(params)
+
+# The queries on the request paths that must be served from an index. check_query_plans
+# fails if SQLite plans a full table scan for any of them. Parameters are placeholders.
+_NOW = '2000-01-01 00:00:00+00:00'
+HOT_QUERIES = {
+    'hot_set_rebuild': ('''
+        SELECT m.*, u.name as user_name
+        FROM markers m
+        JOIN users u ON m.user_username = u.username
+        WHERE m.expires_at > ? AND m.status = ?
+    ''', (_NOW, 'active')),
+    'nearby_ring': ('''
+        SELECT m.*, u.name as user_name
+        FROM (SELECT id FROM markers INDEXED BY idx_markers_geohash_active
+              WHERE status = 'active' AND geohash >= ? AND geohash < ?) c
+        CROSS JOIN markers m ON m.id = c.id
+        JOIN users u ON m.user_username = u.username
+        WHERE m.expires_at > ?
+    ''', ('wx4g0', 'wx4g0{', _NOW)),
+    'get_marker_tile': ('''
+        SELECT m.id, m.lat, m.lng, m.marker_type, m.title, m.expires_at
+        FROM markers_rtree r
+        CROSS JOIN markers m ON m.id = r.id
+        WHERE r.max_lng >= ? AND r.min_lng <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+          AND m.lng BETWEEN ? AND ? AND m.lat BETWEEN ? AND ?
+          AND m.expires_at > ? AND m.status = ?
+        ORDER BY m.created_at DESC
+        LIMIT ?
+    ''', (0, 1, 0, 1, 0, 1, 0, 1, _NOW, 'active', 2001)),
+    'get_user_markers': (USER_MARKERS_QUERY, ('user',)),
+    'add_marker_active_count': (ACTIVE_MARKER_COUNT_QUERY, ('user', 'active')),
+    'login_user': (LOGIN_QUERY, ('user', 'user', 'password')),
+    'auth_user_lookup': ('SELECT * FROM users WHERE username = ?', ('user',)),
+    'expiry_sweep': (
+        "UPDATE markers SET status = 'inactive' WHERE status = 'active' AND expires_at <= ? RETURNING *", (_NOW,)
+    ),
+    'next_expiry': (NEXT_EXPIRY_QUERY, ()),
+    'expired_since_watermark': (
+        'SELECT COUNT(*) FROM markers WHERE expires_at > ? AND expires_at <= ?', (_NOW, _NOW)
+    ),
+    'admin_markers_page': ('''
+        SELECT m.*, u.name as user_name
+        FROM markers m
+        JOIN users u ON m.user_username = u.username
+        WHERE (m.created_at, m.id) < (?, ?)
+        ORDER BY m.created_at DESC, m.id DESC LIMIT ?
+    ''', (_NOW, 1, 100)),
+    'admin_users_page': ('''
+        SELECT u.id, u.username, u.email, u.name, u.contact, u.role, u.created_at, u.avatar_url FROM users u
+        WHERE (u.created_at, u.id) < (?, ?)
+        ORDER BY u.created_at DESC, u.id DESC LIMIT ?
+    ''', (_NOW, 1, 100)),
+    'archive_candidates': (ARCHIVE_CANDIDATES_QUERY, (_NOW, _NOW, 500)),
+    'admin_archived_markers_page': ('''
+        SELECT a.*, u.name as user_name
+        FROM markers_archive a
+        LEFT JOIN users u ON a.user_username = u.username
+        WHERE (a.created_at, a.id) < (?, ?)
+        ORDER BY a.created_at DESC, a.id DESC LIMIT ?
+    ''', (_NOW, 1, 100)),
+    'marker_changes': (MARKER_CHANGES_QUERY, (0, 1001)),
+    'marker_clusters': (CLUSTER_CELLS_QUERY, (0, 0, 1, 0, 1)),
+}
+# Every shape search_markers can take: full-text or substring-only terms, with or without marker_type
+for _name, _terms, _marker_type in [
+    ('search_markers', ['word'], None),
+    ('search_markers_by_type', ['word'], 'personal'),
+    ('search_markers_short_terms', ['wo'], None),
+    ('search_markers_short_terms_by_type', ['wo'], 'personal'),
+]:
+    _count_query, _page_query, _params = search_marker_queries(_terms, _marker_type, _NOW)
+    HOT_QUERIES[_name] = (_page_query, _params + (20, 0))
+    HOT_QUERIES[f'{_name}_count'] = (_count_query, _params)
+
+def check_query_plans(conn):
+    """Runs EXPLAIN QUERY PLAN for HOT_QUERIES and returns {name: plan} for those doing a full table scan."""
+    full_scans = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        plan = [row['detail'] for row in conn.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+        # 'SCAN <table>' without 'USING ... INDEX' reads every row, as does an R*Tree
+        # probed by id only ('INDEX 1:') instead of by its coordinates or a full-text
+        # index probed by rowid ('INDEX 0:=...') once per row of the other table
+        if any(re.fullmatch(r'SCAN \w+', detail)
+               or re.fullmatch(r'SCAN \w+ VIRTUAL TABLE INDEX 1:', detail)
+               or re.fullmatch(r'SCAN \w+_fts VIRTUAL TABLE INDEX 0:=.*', detail) for detail in plan):
+            full_scans[name] = plan
+    return full_scans
+
 def init_db():
-    """Initializes the database and creates the markers table if it doesn't exist."""
+    """Initializes the database by applying any pending schema migrations."""
     with app.app_context():
         conn = get_db_connection()
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            # BEGIN IMMEDIATE serializes concurrent initializations; re-check the version under the lock
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if conn.execute('PRAGMA user_version').fetchone()[0] >= number:
+                    conn.rollback()
+                    continue
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                conn.close()
+                raise
+            print(f"Applied migration {number}: {migration.__doc__.splitlines()[0]}")
         with conn:
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS markers (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    description TEXT NOT NULL,
-                    contact TEXT,
-                    marker_type TEXT NOT NULL,
-                    visibility TEXT NOT NULL,
-                    lat REAL NOT NULL,
-                    lng REAL NOT NULL,
-                    user_username TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    expires_at TIMESTAMP,
-                    status TEXT NOT NULL DEFAULT 'active'
-                )
-            ''')
-            conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    name TEXT,
-                    contact TEXT,
-                    bio TEXT,
-                    gender TEXT DEFAULT 'secret',
-                    age INTEGER,
-                    role TEXT NOT NULL DEFAULT 'user',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    avatar_url TEXT
-                )
-            ''')
-            
-            # Simple migration: rename phone to contact if it exists
-            cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'phone' in columns and 'contact' not in columns:
-                conn.execute('ALTER TABLE users RENAME COLUMN phone TO contact;')
-                print("Migrated 'users' table: renamed 'phone' to 'contact'.")
-
-            # Add avatar_url column to users table if it doesn't exist for backward compatibility
-            if 'avatar_url' not in columns:
-                conn.execute('ALTER TABLE users ADD COLUMN avatar_url TEXT')
-                print("Added 'avatar_url' column to 'users' table.")
-            
-        conn.commit()  # Explicitly commit the changes to the database file
+            sync_cluster_zooms(conn)
         conn.close()
-        print("Database initialized and 'markers' and 'users' tables created.")
+        print("Database initialized.")
 
 def login_required(f):
     @wraps(f)
@@ -86,9 +1422,7 @@ def login_required(f):
         if not username:
             return jsonify({'error': 'Authentication required: Missing username header'}), 401
 
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        user = get_cached_user(username)
 
         if not user:
             return jsonify({'error': 'Authentication failed: User not found'}), 401
@@ -102,58 +1436,1236 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def parse_bbox(value):
+    """Parses a 'minLng,minLat,maxLng,maxLat' string into a list of (west, south, east, north) boxes.
+
+    A box whose minLng is greater than its maxLng crosses the antimeridian and is split in two.
+    Raises ValueError if the string is malformed.
+    """
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError('bbox must have exactly 4 values')
+    min_lng, min_lat, max_lng, max_lat = parts
+    if not (-90 <= min_lat <= max_lat <= 90) or not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+        raise ValueError('bbox is out of range')
+    if min_lng > max_lng:
+        return [(min_lng, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lng, max_lat)]
+    return [(min_lng, min_lat, max_lng, max_lat)]
+
+def parse_timestamp(value):
+    """Parses a timestamp stored by sqlite3 into an aware UTC datetime."""
+    parsed = datetime.datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.UTC)  # CURRENT_TIMESTAMP values are UTC
+    return parsed
+
+def parse_keyset_cursor(value):
+    """Parses an '<created_at>,<id>' keyset pagination cursor."""
+    created_at, _, row_id = value.rpartition(',')
+    if not created_at:
+        raise ValueError('after must be <created_at>,<id>')
+    return created_at, int(row_id)
+
+def parse_point(value):
+    """Parses a 'lat,lng' string into a (lat, lng) tuple, raising ValueError if it is malformed."""
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 2 or not (-90 <= parts[0] <= 90 and -180 <= parts[1] <= 180):
+        raise ValueError('point must be lat,lng within range')
+    return parts[0], parts[1]
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash_encode(lat, lng, precision=GEOHASH_PRECISION):
+    """Encodes a coordinate as a geohash string of the given length."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True  # Bits alternate between longitude and latitude, starting with longitude
+    while len(chars) < precision:
+        value, interval = (lng, lng_range) if even else (lat, lat_range)
+        mid = (interval[0] + interval[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            interval[0] = mid
+        else:
+            bits = bits * 2
+            interval[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+def geohash_cell_size(precision):
+    """Returns the (height, width) in degrees of a geohash cell of the given length."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def compute_expires_at(visibility, now):
+    """Returns when a marker created at now with the given visibility expires."""
+    if visibility == 'today':
+        # Expires at the end of the current UTC day
+        return now.replace(hour=23, minute=59, second=59, microsecond=999999)
+    elif visibility == 'three_days':
+        return now + datetime.timedelta(days=3)
+    else:
+        # Default fallback or for old types - maybe expire in 1 year?
+        return now + datetime.timedelta(days=365)
+
+def parse_limit(value, default=None, maximum=MAX_MARKERS_LIMIT):
+    """Parses an optional positive 'limit' query parameter, capped at maximum."""
+    if value is None or value == '':
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+# --- Hot Marker Set ---
+
+class MarkerArrays:
+    """The active markers as parallel column arrays, one slot per marker.
+
+    id, lat, lng, creation time, expiry and a marker type code are NumPy arrays; the
+    remaining columns are one tuple per marker. Removing a marker moves the last slot
+    into its place, so the arrays stay dense.
+    """
+
+    ARRAY_COLUMNS = ('id', 'lat', 'lng', 'marker_type', 'status', 'user_name')
+
+    def __init__(self, capacity, columns):
+        self.columns = [c for c in columns if c not in self.ARRAY_COLUMNS]
+        self.count = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.lat = np.zeros(capacity)
+        self.lng = np.zeros(capacity)
+        self.created = np.zeros(capacity)
+        self.expires = np.zeros(capacity)
+        self.types = np.zeros(capacity, dtype=np.int32)
+        self.records = []
+        self.slots = {}  # marker id -> slot
+        self.type_names = []
+        self.type_codes = {}
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+        for name in ('ids', 'lat', 'lng', 'created', 'expires', 'types'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+    def upsert(self, marker):
+        slot = self.slots.get(marker['id'])
+        if slot is None:
+            if self.count == len(self.ids):
+                self._grow()
+            slot = self.count
+            self.count += 1
+            self.slots[marker['id']] = slot
+            self.records.append(None)
+        marker_type = sys.intern(marker['marker_type'])
+        code = self.type_codes.get(marker_type)
+        if code is None:
+            code = self.type_codes[marker_type] = len(self.type_names)
+            self.type_names.append(marker_type)
+        self.ids[slot] = marker['id']
+        self.lat[slot] = marker['lat']
+        self.lng[slot] = marker['lng']
+        self.created[slot] = parse_timestamp(marker['created_at']).timestamp() if marker['created_at'] else 0
+        # A marker without an expiry is never returned, just like in the SQL queries
+        self.expires[slot] = parse_timestamp(marker['expires_at']).timestamp() if marker['expires_at'] else 0
+        self.types[slot] = code
+        self.records[slot] = tuple(
+            sys.intern(marker[c]) if c in ('user_username', 'visibility') else marker[c] for c in self.columns
+        )
+
+    def remove(self, marker_id):
+        slot = self.slots.pop(marker_id, None)
+        if slot is None:
+            return
+        last = self.count - 1
+        if slot != last:
+            for array in (self.ids, self.lat, self.lng, self.created, self.expires, self.types):
+                array[slot] = array[last]
+            self.records[slot] = self.records[last]
+            self.slots[int(self.ids[slot])] = slot
+        self.records.pop()
+        self.count = last
+
+    def memory_bytes(self):
+        arrays = sum(a.nbytes for a in (self.ids, self.lat, self.lng, self.created, self.expires, self.types))
+        # The interned columns (usernames, visibility) are shared and not counted per marker
+        counted = [i for i, c in enumerate(self.columns) if c not in ('user_username', 'visibility')]
+        records = sys.getsizeof(self.records) + sum(
+            sys.getsizeof(r) + sum(sys.getsizeof(r[i]) for i in counted) for r in self.records
+        )
+        return arrays + records + sys.getsizeof(self.slots)
+
+class HotMarkerSet:
+    """In-process read model of the active markers, serving /api/markers without the database.
+
+    Filters on bbox, marker type and expiry, and nearest-k searches, are vectorized
+    scans over MarkerArrays. It is loaded on the first request of a process and kept
+    current by the marker change listeners (including other workers' changes when
+    the change log follower runs). The expiry scheduler rebuilds it every
+    HOT_SET_REFRESH_INTERVAL seconds to pick up writes made outside the app.
+    User display names are interned once per user.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self.data = MarkerArrays(HOT_SET_INITIAL_CAPACITY, [])
+        self.user_names = {}
+        self.loaded_path = None
+        self._pending = None  # Changes notified while a rebuild reads its snapshot
+        self.rebuilt_at = 0
+        self.rebuilds = 0
+        self.last_rebuild_ms = None
+
+    def ensure_loaded(self):
+        if self.loaded_path != DATABASE:
+            with self._rebuild_lock:
+                # Threads that waited for another thread's initial load don't load again
+                if self.loaded_path != DATABASE:
+                    self._rebuild()
+
+    def rebuild(self):
+        """Reloads all active markers from the database and swaps them in."""
+        with self._rebuild_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        """rebuild() without taking _rebuild_lock, which the caller holds."""
+        started = time.perf_counter()
+        with self._lock:
+            self._pending = []
+        try:
+            conn = get_db_connection()
+            cursor = conn.execute('''
+                SELECT m.*, u.name as user_name
+                FROM markers m
+                JOIN users u ON m.user_username = u.username
+                WHERE m.expires_at > ? AND m.status = ?
+            ''', (datetime.datetime.now(datetime.UTC), 'active'))
+            columns = [d[0] for d in cursor.description]
+            data = MarkerArrays(HOT_SET_INITIAL_CAPACITY, columns)
+            user_names = {}
+            while True:
+                rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    marker = dict(row)
+                    data.upsert(marker)
+                    user_names[sys.intern(marker['user_username'])] = marker['user_name']
+            conn.close()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            self.data = data
+            self.user_names = user_names
+            for kind, markers in self._pending:
+                self._apply(kind, markers)
+            self._pending = None
+            self.loaded_path = DATABASE
+            self.rebuilt_at = time.monotonic()
+            self.rebuilds += 1
+            self.last_rebuild_ms = round((time.perf_counter() - started) * 1000, 3)
+        print(f"Loaded {data.count} active markers into the hot set in {self.last_rebuild_ms} ms")
+
+    def apply(self, kind, markers):
+        """Applies committed marker changes, as passed to the marker change listeners."""
+        with self._lock:
+            # Before the first load only changes made while it reads its snapshot matter
+            if self.loaded_path is None and self._pending is None:
+                return
+        unknown = {m['user_username'] for m in markers if 'user_username' in m and 'user_name' not in m} - set(self.user_names)
+        names = {}
+        if unknown:
+            conn = get_db_connection()
+            placeholders = ', '.join('?' for _ in unknown)
+            names = {row['username']: row['name'] for row in conn.execute(
+                f'SELECT username, name FROM users WHERE username IN ({placeholders})', tuple(unknown)
+            )}
+            conn.close()
+        with self._lock:
+            for username, name in names.items():
+                self.user_names[sys.intern(username)] = name
+            if self._pending is not None:
+                self._pending.append((kind, markers))
+            self._apply(kind, markers)
+
+    def _apply(self, kind, markers):
+        for marker in markers:
+            if kind == 'deleted' or marker.get('status') != 'active':
+                self.data.remove(marker['id'])
+                continue
+            if 'user_name' in marker:
+                self.user_names[sys.intern(marker['user_username'])] = marker['user_name']
+            self.data.upsert(marker)
+
+    def rename_user(self, username, name):
+        with self._lock:
+            if username in self.user_names:
+                self.user_names[username] = name
+
+    def query(self, boxes=None, marker_type=None, limit=None, near=None, k=None):
+        """Returns active, unexpired markers as dicts with the columns of 'SELECT m.*, u.name as user_name'.
+
+        Without near, markers are newest first. With near=(lat, lng), the k closest are
+        returned nearest first, each with its great-circle 'distance_m'.
+        """
+        now = datetime.datetime.now(datetime.UTC).timestamp()
+        with self._lock:
+            data = self.data
+            n = data.count
+            lat, lng = data.lat[:n], data.lng[:n]
+            mask = data.expires[:n] > now
+            if boxes:
+                in_box = np.zeros(n, dtype=bool)
+                for west, south, east, north in boxes:
+                    in_box |= (lng >= west) & (lng <= east) & (lat >= south) & (lat <= north)
+                mask &= in_box
+            if marker_type is not None:
+                code = data.type_codes.get(marker_type)
+                if code is None:
+                    return []
+                mask &= data.types[:n] == code
+            slots = np.flatnonzero(mask)
+
+            distances = None
+            if near is not None:
+                distances = haversine_m(near[0], near[1], lat[slots], lng[slots])
+                if k is not None and k < len(slots):
+                    nearest = np.argpartition(distances, k - 1)[:k]
+                    slots, distances = slots[nearest], distances[nearest]
+                order = np.argsort(distances, kind='stable')
+                slots, distances = slots[order], distances[order]
+            else:
+                # Newest first, like ORDER BY created_at DESC
+                order = np.lexsort((-data.ids[slots], -data.created[slots]))
+                slots = slots[order][:limit] if limit is not None else slots[order]
+
+            markers = []
+            type_names = data.type_names
+            for position, slot in enumerate(slots.tolist()):
+                record = data.records[slot]
+                marker = dict(zip(data.columns, record))
+                marker['id'] = int(data.ids[slot])
+                marker['lat'] = float(data.lat[slot])
+                marker['lng'] = float(data.lng[slot])
+                marker['marker_type'] = type_names[data.types[slot]]
+                marker['status'] = 'active'
+                marker['user_name'] = self.user_names.get(marker['user_username'])
+                if distances is not None:
+                    marker['distance_m'] = round(float(distances[position]), 1)
+                markers.append(marker)
+            return markers
+
+    def stats(self):
+        with self._lock:
+            data = self.data
+            memory = data.memory_bytes()
+            return {
+                'loaded': self.loaded_path is not None,
+                'markers': data.count,
+                'capacity': len(data.ids),
+                'users': len(self.user_names),
+                'memory_bytes': memory,
+                'bytes_per_marker': round(memory / data.count) if data.count else None,
+                'rebuilds': self.rebuilds,
+                'last_rebuild_ms': self.last_rebuild_ms,
+            }
+
+def haversine_m(lat, lng, lats, lngs):
+    """Great-circle distances in meters from (lat, lng) to arrays of coordinates."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+hot_markers = HotMarkerSet()
+on_marker_change(hot_markers.apply)
+
 # --- API Endpoints ---
 
 @app.route('/api/markers', methods=['GET'])
 def get_markers():
-    """API endpoint to get all markers from the database."""
-    # 首先自动检查并更新过期标注的状态
-    auto_update_expired_markers()
-    
+    """API endpoint to get all markers, optionally filtered, served from the in-memory hot set.
+
+    Query parameters:
+        bbox: 'minLng,minLat,maxLng,maxLat' viewport.
+        marker_type: only markers of this type.
+        limit: maximum number of markers to return.
+        near: 'lat,lng'. Returns the nearest markers first, each with 'distance_m';
+            limit defaults to 20.
+    """
+    try:
+        boxes = parse_bbox(request.args['bbox']) if request.args.get('bbox') else None
+        near = parse_point(request.args['near']) if request.args.get('near') else None
+        limit = parse_limit(request.args.get('limit'), 20 if near else None)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    marker_type = request.args.get('marker_type') or None
+
+    # Serve unchanged polls from the per-version body cache
+    cache_key = (tuple(boxes) if boxes else None, limit, marker_type, near)
+    version = marker_data_version.value
+    now = datetime.datetime.now(datetime.UTC)
+    cached = marker_feed_cache.get(cache_key)
+    if cached and cached['version'] == version and (cached['valid_until'] is None or now < cached['valid_until']):
+        return marker_feed_response(cached)
+
+    hot_markers.ensure_loaded()
+    if near:
+        markers = hot_markers.query(boxes, marker_type, near=near, k=limit)
+    else:
+        markers = hot_markers.query(boxes, marker_type, limit)
+
+    body = app.json.dumps(markers).encode('utf-8')
+    # The body goes stale without any write once its earliest marker expires
+    expiries = [m['expires_at'] for m in markers if m['expires_at']]
+    entry = {
+        'version': version,
+        'valid_until': parse_timestamp(min(expiries)) if expiries else None,
+        'etag': hashlib.blake2b(body, digest_size=16).hexdigest(),
+        'body': body,
+    }
+    marker_feed_cache.set(cache_key, entry)
+    return marker_feed_response(entry)
+
+def marker_feed_response(entry):
+    """Builds a response for a cached feed body, answering If-None-Match with 304."""
+    response = Response(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    response.cache_control.no_cache = True  # Clients must revalidate, which is cheap
+    return response.make_conditional(request)
+
+@app.route('/api/markers/search', methods=['GET'])
+def search_markers():
+    """API endpoint for ranked full-text search over active markers.
+
+    Query parameters:
+        q: search terms, all of which must match title, description or contact.
+        marker_type: optional marker type filter.
+        page, per_page: pagination, per_page is capped at SEARCH_MAX_PER_PAGE.
+    """
+    terms = request.args.get('q', '').split()
+    if not terms:
+        return jsonify({'error': 'Missing search query'}), 400
+    try:
+        page = int(request.args.get('page', 1))
+        per_page = min(int(request.args.get('per_page', 20)), SEARCH_MAX_PER_PAGE)
+        if page < 1 or per_page < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+
+    count_query, page_query, params = search_marker_queries(
+        terms, request.args.get('marker_type'), datetime.datetime.now(datetime.UTC)
+    )
     conn = get_db_connection()
-    markers_cursor = conn.execute('''
-        SELECT m.*, u.name as user_name 
-        FROM markers m
-        JOIN users u ON m.user_username = u.username
-        WHERE m.expires_at > ? AND m.status = ? 
-        ORDER BY m.created_at DESC
-    ''', (datetime.datetime.now(datetime.UTC), 'active'))
-    markers = [dict(row) for row in markers_cursor.fetchall()]
+    total = conn.execute(count_query, params).fetchone()[0]
+    results_cursor = conn.execute(page_query, params + (per_page, (page - 1) * per_page))
+    results = [dict(row) for row in results_cursor.fetchall()]
     conn.close()
-    return jsonify(markers)
 
-def auto_update_expired_markers():
-    """自动检查并更新过期标注的状态为inactive"""
+    return jsonify({
+        'query': ' '.join(terms),
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'results': results
+    })
+
+@app.route('/api/markers/changes', methods=['GET'])
+def get_marker_changes():
+    """API endpoint for delta sync of the active marker set.
+
+    Returns the markers created or updated since the 'since' cursor, the ids of markers
+    that were deleted, deactivated or expired since then ('removed'), and the cursor to
+    pass next time. Without a cursor, or with one older than the pruned tombstones, the
+    full active set is returned with 'reset': true. 'has_more' means the client should
+    immediately ask again with the new cursor.
+    """
+    try:
+        since = int(request.args.get('since', 0))
+        if since < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    now = datetime.datetime.now(datetime.UTC)
     conn = get_db_connection()
+    pruned_row = conn.execute("SELECT value FROM app_meta WHERE key = 'marker_changes_pruned_seq'").fetchone()
+    pruned_seq = pruned_row['value'] if pruned_row else 0
+
+    if since == 0 or since < pruned_seq:
+        # Read the cursor first: changes racing with the snapshot are replayed next time
+        cursor_value = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM marker_changes').fetchone()[0]
+        markers_cursor = conn.execute('''
+            SELECT m.*, u.name as user_name
+            FROM markers m
+            JOIN users u ON m.user_username = u.username
+            WHERE m.expires_at > ? AND m.status = ?
+            ORDER BY m.created_at DESC
+        ''', (now, 'active'))
+        markers = [dict(row) for row in markers_cursor.fetchall()]
+        conn.close()
+        return jsonify({'reset': True, 'cursor': cursor_value, 'has_more': False, 'markers': markers, 'removed': []})
+
+    changes = conn.execute(MARKER_CHANGES_QUERY, (since, CHANGES_PAGE_SIZE + 1)).fetchall()
+    has_more = len(changes) > CHANGES_PAGE_SIZE
+    changes = changes[:CHANGES_PAGE_SIZE]
+
+    upserted_ids = [row['marker_id'] for row in changes if row['op'] == 'upsert']
+    markers = []
+    if upserted_ids:
+        placeholders = ', '.join('?' for _ in upserted_ids)
+        markers_cursor = conn.execute(f'''
+            SELECT m.*, u.name as user_name
+            FROM markers m
+            JOIN users u ON m.user_username = u.username
+            WHERE m.id IN ({placeholders}) AND m.expires_at > ? AND m.status = ?
+        ''', tuple(upserted_ids) + (now, 'active'))
+        markers = [dict(row) for row in markers_cursor.fetchall()]
+    conn.close()
+
+    # Everything that changed but is no longer visible is a tombstone for the client
+    visible_ids = {m['id'] for m in markers}
+    removed = [row['marker_id'] for row in changes if row['marker_id'] not in visible_ids]
+
+    return jsonify({
+        'reset': False,
+        'cursor': changes[-1]['seq'] if changes else since,
+        'has_more': has_more,
+        'markers': markers,
+        'removed': removed
+    })
+
+@app.route('/api/markers/clusters', methods=['GET'])
+def get_marker_clusters():
+    """API endpoint returning active markers aggregated into grid cells for a zoom level.
+
+    Query parameters:
+        zoom: map zoom level, values above CLUSTER_MAX_ZOOM use the deepest grid.
+        bbox: optional 'minLng,minLat,maxLng,maxLat', defaults to the whole world.
+
+    Each cluster carries its marker count, centroid and per-marker_type counts. The
+    cells are maintained by triggers, so the cost depends on the number of cells.
+    """
+    try:
+        zoom = int(request.args.get('zoom', 0))
+        if zoom < 0:
+            raise ValueError('zoom must not be negative')
+        boxes = parse_bbox(request.args['bbox']) if request.args.get('bbox') else [(-180.0, -90.0, 180.0, 90.0)]
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+
+    zoom = min(zoom, CLUSTER_MAX_ZOOM)
+    cell_deg = CLUSTER_CELL_DEG_Z0 / 2 ** zoom
+    last_x = int(360 / cell_deg) - 1
+    last_y = int(180 / cell_deg) - 1
+
+    # The two halves of a split bbox can cover the same cells at low zoom, so merge
+    # overlapping cell ranges before reading them, otherwise cells are counted twice
+    ranges = []
+    for west, south, east, north in sorted(boxes):
+        x_range = [int((west + 180) / cell_deg), min(int((east + 180) / cell_deg), last_x)]
+        y_range = (int((south + 90) / cell_deg), min(int((north + 90) / cell_deg), last_y))
+        if ranges and ranges[-1][1] == y_range and x_range[0] <= ranges[-1][0][1] + 1:
+            ranges[-1][0][1] = max(ranges[-1][0][1], x_range[1])
+        else:
+            ranges.append((x_range, y_range))
+
+    conn = get_db_connection()
+    cells = {}
+    for (min_x, max_x), (min_y, max_y) in ranges:
+        rows = conn.execute(CLUSTER_CELLS_QUERY, (zoom, min_x, max_x, min_y, max_y)).fetchall()
+        for row in rows:
+            cell = cells.setdefault((row['cell_x'], row['cell_y']), {'count': 0, 'sum_lat': 0.0, 'sum_lng': 0.0, 'types': {}})
+            cell['count'] += row['count']
+            cell['sum_lat'] += row['sum_lat']
+            cell['sum_lng'] += row['sum_lng']
+            cell['types'][row['marker_type']] = row['count']
+    conn.close()
+
+    clusters = []
+    for (cell_x, cell_y), cell in cells.items():
+        west = cell_x * cell_deg - 180
+        south = cell_y * cell_deg - 90
+        clusters.append({
+            'cell': [cell_x, cell_y],
+            'bounds': [west, south, west + cell_deg, south + cell_deg],
+            'count': cell['count'],
+            'lat': cell['sum_lat'] / cell['count'],
+            'lng': cell['sum_lng'] / cell['count'],
+            'types': cell['types']
+        })
+    return jsonify({'zoom': zoom, 'cell_size_deg': cell_deg, 'clusters': clusters})
+
+@app.route('/api/markers/nearby', methods=['GET'])
+def get_nearby_markers():
+    """API endpoint returning the k active markers closest to a point, within radius_m meters.
+
+    Query parameters:
+        lat, lng: the point.
+        radius_m: search radius in meters (default NEARBY_DEFAULT_RADIUS_M).
+        k: number of markers to return (default 20, at most NEARBY_MAX_K).
+
+    Geohash cells around the point are searched ring by ring until k markers are found
+    closer than the area already covered, so the cost follows the local marker density.
+    """
+    try:
+        lat, lng = parse_point(f"{request.args['lat']},{request.args['lng']}")
+        radius_m = float(request.args.get('radius_m', NEARBY_DEFAULT_RADIUS_M))
+        k = parse_limit(request.args.get('k'), 20, NEARBY_MAX_K)
+        if not 0 < radius_m <= NEARBY_MAX_RADIUS_M:
+            raise ValueError(f'radius_m must be between 0 and {NEARBY_MAX_RADIUS_M}')
+    except KeyError:
+        return jsonify({'error': 'lat and lng are required'}), 400
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+
+    meters_per_degree = math.pi * EARTH_RADIUS_M / 180
+    # The finest precision whose cells cover the radius within NEARBY_MAX_RINGS rings
+    precision = GEOHASH_PRECISION
+    while precision > 1:
+        height, width = geohash_cell_size(precision)
+        max_lat = min(90.0, abs(lat) + radius_m / meters_per_degree)
+        min_side_m = min(height, width * math.cos(math.radians(max_lat))) * meters_per_degree
+        if min_side_m * NEARBY_MAX_RINGS >= radius_m:
+            break
+        precision -= 1
+    height, width = geohash_cell_size(precision)
+
     now = datetime.datetime.now(datetime.UTC)
-    
-    # 查找所有已过期但状态仍为active的标注
-    expired_cursor = conn.execute('''
-        SELECT id, title, user_username, expires_at 
-        FROM markers 
-        WHERE expires_at <= ? AND status = 'active'
-    ''', (now,))
-    expired_markers = expired_cursor.fetchall()
-    
-    updated_count = 0
-    for marker in expired_markers:
-        # 更新状态为inactive
+    seen_cells = set()
+    candidates = {}
+    conn = get_db_connection()
+    ring = 0
+    while True:
+        cells = set()
+        for i in range(-ring, ring + 1):
+            for j in range(-ring, ring + 1):
+                if max(abs(i), abs(j)) != ring:
+                    continue
+                cell_lat = lat + j * height
+                if not -90 <= cell_lat <= 90:
+                    continue
+                cell_lng = (lng + i * width + 180) % 360 - 180
+                cells.add(geohash_encode(cell_lat, cell_lng, precision))
+        cells -= seen_cells
+        seen_cells |= cells
+        if cells:
+            ranges = sorted(cells)
+            # Every marker in a cell has a geohash starting with the cell's, '{' sorts after 'z'
+            cell_sql = ' UNION ALL '.join(
+                "SELECT id FROM markers INDEXED BY idx_markers_geohash_active"
+                " WHERE status = 'active' AND geohash >= ? AND geohash < ?"
+                for _ in ranges
+            )
+            rows = conn.execute(f'''
+                SELECT m.*, u.name as user_name
+                FROM ({cell_sql}) c
+                CROSS JOIN markers m ON m.id = c.id
+                JOIN users u ON m.user_username = u.username
+                WHERE m.expires_at > ?
+            ''', tuple(value for cell in ranges for value in (cell, cell + '{')) + (now,)).fetchall()
+            distances = haversine_m(lat, lng, np.array([row['lat'] for row in rows]), np.array([row['lng'] for row in rows]))
+            for row, distance in zip(rows, distances.tolist()):
+                if distance <= radius_m:
+                    candidates[row['id']] = (distance, dict(row))
+
+        # Everything closer than 'covered' lies in the rings searched so far
+        max_lat = min(90.0, abs(lat) + (ring + 1) * height)
+        covered = ring * min(height * meters_per_degree, width * math.cos(math.radians(max_lat)) * meters_per_degree)
+        found = sum(1 for distance, _ in candidates.values() if distance <= covered)
+        if found >= k or covered >= radius_m or ring >= 2 * NEARBY_MAX_RINGS or len(seen_cells) >= 2 ** (5 * precision):
+            break
+        ring += 1
+    conn.close()
+
+    markers = []
+    for distance, marker in sorted(candidates.values(), key=lambda c: (c[0], c[1]['id']))[:k]:
+        marker['distance_m'] = round(distance, 1)
+        markers.append(marker)
+    return jsonify({
+        'lat': lat,
+        'lng': lng,
+        'radius_m': radius_m,
+        'k': k,
+        'geohash_precision': precision,
+        'rings_searched': ring + 1,
+        'markers': markers
+    })
+
+# --- Map Tiles ---
+
+TILE_FIELDS = ['id', 'lat', 'lng', 'marker_type', 'title', 'expires_at']
+
+def tile_bounds(z, x, y):
+    """Returns (west, south, east, north) of an XYZ web mercator tile.
+
+    The outermost tile rows extend to the poles so no marker falls outside every tile.
+    """
+    n = 2 ** z
+    def lat_of(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    north = 90.0 if y == 0 else lat_of(y)
+    south = -90.0 if y == n - 1 else lat_of(y + 1)
+    return x / n * 360 - 180, south, (x + 1) / n * 360 - 180, north
+
+def tiles_for_point(z, lat, lng):
+    """Returns the XYZ tiles containing a point, more than one if it lies on a tile edge."""
+    n = 2 ** z
+    tiles = set()
+    for d_lat in (-1e-9, 1e-9):
+        for d_lng in (-1e-9, 1e-9):
+            point_lat = max(min(lat + d_lat, 85.0511), -85.0511)
+            point_lng = lng + d_lng
+            x = int((point_lng + 180) / 360 * n)
+            y = int((1 - math.asinh(math.tan(math.radians(point_lat))) / math.pi) / 2 * n)
+            tiles.add((z, min(max(x, 0), n - 1), min(max(y, 0), n - 1)))
+    return tiles
+
+def tile_disk_path(z, x, y):
+    return os.path.join(TILE_CACHE_DIR, str(z), str(x), f'{y}.json')
+
+def load_tile(key):
+    """Looks a tile up in the memory cache, then in the optional disk layer."""
+    entry = tile_cache.get(key)
+    if entry is None and TILE_CACHE_DIR:
+        try:
+            with open(tile_disk_path(*key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        valid_until = parse_timestamp(meta['valid_until']) if meta['valid_until'] else None
+        entry = {'etag': meta['etag'], 'valid_until': valid_until, 'body': body}
+        tile_cache.set(key, entry)
+    return entry
+
+def store_tile(key, entry):
+    tile_cache.set(key, entry)
+    if TILE_CACHE_DIR:
+        path = tile_disk_path(*key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            meta = {
+                'etag': entry['etag'],
+                'valid_until': entry['valid_until'].isoformat() if entry['valid_until'] else None
+            }
+            # Write then rename so other workers never read a partial tile
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n' + entry['body'])
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing tile cache file {path}: {e}")
+
+@on_marker_change
+def invalidate_marker_tiles(kind, markers):
+    """Drops exactly the cached tiles, on every zoom level, that contain a changed marker."""
+    for marker in markers:
+        if 'lat' not in marker:
+            tile_cache.clear()  # Deleted by another process, which already removed its disk tiles
+            return
+        for z in range(TILE_MAX_ZOOM + 1):
+            for key in tiles_for_point(z, marker['lat'], marker['lng']):
+                tile_cache.invalidate(key)
+                if TILE_CACHE_DIR:
+                    try:
+                        os.remove(tile_disk_path(*key))
+                    except FileNotFoundError:
+                        pass
+
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def get_marker_tile(z, x, y):
+    """API endpoint serving the active markers of one XYZ tile as compact JSON.
+
+    Markers are encoded as arrays in the order given by 'fields'. Tiles are cached in
+    memory (and on disk if MAPCONNECT_TILE_CACHE_DIR is set) until a marker inside them
+    changes, and are sent with public Cache-Control and an ETag so browsers and CDNs can
+    share them across users.
+    """
+    n = 2 ** z if 0 <= z <= TILE_MAX_ZOOM else 0
+    if not (0 <= x < n and 0 <= y < n):
+        return jsonify({'error': 'Tile out of range'}), 404
+
+    key = (z, x, y)
+    now = datetime.datetime.now(datetime.UTC)
+    entry = load_tile(key)
+    if entry is None or (entry['valid_until'] is not None and now >= entry['valid_until']):
+        version = marker_data_version.value
+        west, south, east, north = tile_bounds(z, x, y)
+        conn = get_db_connection()
+        rows = conn.execute(f'''
+            SELECT {', '.join('m.' + field for field in TILE_FIELDS)}
+            FROM markers_rtree r
+            CROSS JOIN markers m ON m.id = r.id
+            WHERE r.max_lng >= ? AND r.min_lng <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+              AND m.lng BETWEEN ? AND ? AND m.lat BETWEEN ? AND ?
+              AND m.expires_at > ? AND m.status = ?
+            ORDER BY m.created_at DESC
+            LIMIT ?
+        ''', (west, east, south, north, west, east, south, north, now, 'active', TILE_MAX_MARKERS + 1)).fetchall()
+        conn.close()
+
+        markers = [list(row) for row in rows[:TILE_MAX_MARKERS]]
+        body = app.json.dumps({
+            'z': z, 'x': x, 'y': y,
+            'fields': TILE_FIELDS,
+            'markers': markers,
+            'truncated': len(rows) > TILE_MAX_MARKERS
+        }).encode('utf-8')
+        expiries = [row['expires_at'] for row in rows if row['expires_at']]
+        entry = {
+            'etag': hashlib.blake2b(body, digest_size=16).hexdigest(),
+            'valid_until': parse_timestamp(min(expiries)) if expiries else None,
+            'body': body
+        }
+        # A write during the query may already have invalidated this tile
+        if marker_data_version.value == version:
+            store_tile(key, entry)
+
+    response = Response(entry['body'], mimetype='application/json')
+    response.set_etag(entry['etag'])
+    max_age = TILE_MAX_AGE
+    if entry['valid_until'] is not None:
+        # Shared caches must not serve a marker past its expiry
+        max_age = max(0, min(max_age, int((entry['valid_until'] - now).total_seconds())))
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+# --- Live Updates ---
+
+class MarkerEventBroker:
+    """In-process fan-out of marker changes to Server-Sent Events subscribers.
+
+    Each change is serialized once and pushed into the bounded queue of every
+    subscriber whose bbox contains the marker. A subscriber whose queue is full is
+    dropped; its client reconnects with Last-Event-ID and is replayed from a short
+    history, or told to resync if it fell too far behind. Writes made by other
+    worker processes are published too when the ChangeLogFollower replays them.
+    """
+
+    def __init__(self, queue_size, history, max_subscribers):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.epoch = uuid.uuid4().hex[:8]  # Event ids from another process or run are not replayable
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, kind, markers):
+        with self._lock:
+            for marker in markers:
+                self._seq += 1
+                event = {
+                    'id': f'{self.epoch}-{self._seq}',
+                    'seq': self._seq,
+                    'lat': marker.get('lat'),
+                    'lng': marker.get('lng'),
+                    'data': f"id: {self.epoch}-{self._seq}\nevent: marker-{kind}\n"
+                            f"data: {app.json.dumps(marker)}\n\n"
+                }
+                self._history.append(event)
+                self.published += 1
+                for subscriber in list(self._subscribers):
+                    if not subscriber.wants(event):
+                        continue
+                    try:
+                        subscriber.events.put_nowait(event['data'])
+                    except queue.Full:
+                        self._drop(subscriber)
+
+    def _drop(self, subscriber):
+        self._subscribers.discard(subscriber)
+        self.dropped += 1
+        subscriber.events = queue.Queue(maxsize=1)
+        subscriber.events.put_nowait(None)  # Ends the stream so the client reconnects
+
+    def subscribe(self, boxes, last_event_id=None):
+        """Registers a subscriber, replaying what it missed since last_event_id.
+
+        Returns None when the broker is at max_subscribers.
+        """
+        subscriber = MarkerEventSubscriber(boxes, self.queue_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            if last_event_id:
+                epoch, _, seq = last_event_id.partition('-')
+                oldest = self._history[0]['seq'] if self._history else self._seq + 1
+                if epoch != self.epoch or not seq.isdigit() or int(seq) < oldest - 1:
+                    subscriber.events.put_nowait(f"id: {self.epoch}-{self._seq}\nevent: reset\ndata: {{}}\n\n")
+                else:
+                    missed = [e['data'] for e in self._history if e['seq'] > int(seq) and subscriber.wants(e)]
+                    if len(missed) >= self.queue_size:
+                        subscriber.events.put_nowait(f"id: {self.epoch}-{self._seq}\nevent: reset\ndata: {{}}\n\n")
+                    else:
+                        for data in missed:
+                            subscriber.events.put_nowait(data)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self.published,
+                'dropped_subscribers': self.dropped,
+                'last_event_id': f'{self.epoch}-{self._seq}',
+            }
+
+class MarkerEventSubscriber:
+    """A live stream client: its optional bbox filter and its bounded event queue."""
+
+    def __init__(self, boxes, queue_size):
+        self.boxes = boxes
+        self.events = queue.Queue(maxsize=queue_size)
+
+    def wants(self, event):
+        if not self.boxes or event['lat'] is None:
+            return True
+        return any(west <= event['lng'] <= east and south <= event['lat'] <= north
+                   for west, south, east, north in self.boxes)
+
+marker_events = MarkerEventBroker(STREAM_QUEUE_SIZE, STREAM_HISTORY_SIZE, STREAM_MAX_SUBSCRIBERS)
+on_marker_change(marker_events.publish)
+
+@app.route('/api/markers/stream', methods=['GET'])
+def stream_marker_changes():
+    """API endpoint streaming marker changes as Server-Sent Events.
+
+    Events are marker-created, marker-status, marker-updated, marker-deleted and
+    marker-expired with the marker as data. Changes made by other worker processes
+    arrive a poll interval later and their kind is derived from the changed row, so
+    an edit that only changes the status is a marker-status event. An optional bbox
+    limits them to a viewport. A 'reset' event means the client missed events and should refetch
+    /api/markers. Idle streams only receive heartbeat comments and never touch
+    the database.
+    """
+    boxes = None
+    if request.args.get('bbox'):
+        try:
+            boxes = parse_bbox(request.args['bbox'])
+        except ValueError as e:
+            return jsonify({'error': f'Invalid bbox: {e}'}), 400
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    subscriber = marker_events.subscribe(boxes, last_event_id)
+    if subscriber is None:
+        response = jsonify({'error': 'Too many live connections, try again later'})
+        response.headers['Retry-After'] = str(STREAM_RETRY_MS // 1000)
+        return response, 503
+
+    def generate():
+        try:
+            yield f'retry: {STREAM_RETRY_MS}\n\n'
+            while True:
+                try:
+                    data = subscriber.events.get(timeout=STREAM_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if data is None:
+                    return
+                yield data
+        finally:
+            marker_events.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
+
+def prune_marker_changes():
+    """Removes change log tombstones older than CHANGE_LOG_TOMBSTONE_DAYS.
+
+    The highest pruned sequence number is remembered so clients holding an older
+    cursor are told to resync instead of silently missing deletes.
+    """
+    cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=CHANGE_LOG_TOMBSTONE_DAYS)
+    conn = get_db_connection()
+    pruned = conn.execute(
+        "DELETE FROM marker_changes WHERE op = 'delete' AND changed_at < ? RETURNING seq",
+        (cutoff.strftime('%Y-%m-%d %H:%M:%S'),)
+    ).fetchall()
+    if pruned:
         conn.execute('''
-            UPDATE markers 
-            SET status = 'inactive' 
-            WHERE id = ?
-        ''', (marker[0],))
-        updated_count += 1
-        print(f"自动过期: 标注ID {marker[0]} '{marker[1]}' (用户: {marker[2]}) 已过期，状态已更新为inactive")
-    
+            INSERT INTO app_meta (key, value) VALUES ('marker_changes_pruned_seq', ?)
+            ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)
+        ''', (max(row['seq'] for row in pruned),))
     conn.commit()
     conn.close()
-    
+    return len(pruned)
+
+def auto_update_expired_markers():
+    """将所有已过期但状态仍为active的标注一次性更新为inactive, 返回更新的数量"""
+    conn = get_db_connection()
+    now = datetime.datetime.now(datetime.UTC)
+    expired = conn.execute('''
+        UPDATE markers
+        SET status = 'inactive'
+        WHERE status = 'active' AND expires_at <= ?
+        RETURNING *
+    ''', (now,)).fetchall()
+    conn.commit()
+    conn.close()
+
+    updated_count = len(expired)
     if updated_count > 0:
+        notify_marker_change('expired', [dict(row) for row in expired])
         print(f"自动状态更新完成: 共更新 {updated_count} 个过期标注的状态")
-    
+
     return updated_count
 
+class ExpiryScheduler:
+    """Background thread that expires markers (and prunes the change log) off the request path.
+
+    Each sweep is a single set-based UPDATE. Between sweeps the thread sleeps until
+    the earliest expires_at of an active marker (capped at max_interval seconds);
+    schedule() wakes it early when a marker with an earlier expiry is added.
+    """
+
+    def __init__(self, max_interval):
+        self.max_interval = max_interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.next_run_at = None
+        self.runs = 0
+        self.total_expired = 0
+        self.last_run_at = None
+        self.last_expired = 0
+        self.last_duration_ms = None
+        self.last_error = None
+        self._last_pruned_at = 0
+        self._last_reconciled_at = time.monotonic()  # init_db reconciles new counters itself
+        self._last_archive_check_at = 0
+
+    def start(self):
+        """Starts the scheduler thread once per process."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='expiry-scheduler', daemon=True)
+            self._thread.start()
+
+    def schedule(self, expires_at):
+        """Wakes the scheduler early if expires_at is before its next planned sweep."""
+        next_run_at = self.next_run_at
+        if next_run_at is None or expires_at < next_run_at:
+            self._wakeup.set()
+
+    def run_once(self):
+        """Runs a single expiry sweep and records how many markers it expired and how long it took."""
+        started = time.perf_counter()
+        expired = auto_update_expired_markers()
+        advance_expired_counter()
+        duration_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.runs += 1
+            self.total_expired += expired
+            self.last_run_at = datetime.datetime.now(datetime.UTC)
+            self.last_expired = expired
+            self.last_duration_ms = round(duration_ms, 3)
+        return expired
+
+    def _seconds_until_next_expiry(self):
+        conn = get_db_connection()
+        row = conn.execute(NEXT_EXPIRY_QUERY).fetchone()
+        conn.close()
+        if row[0] is None:
+            return self.max_interval
+        next_expiry = parse_timestamp(row[0])
+        delay = (next_expiry - datetime.datetime.now(datetime.UTC)).total_seconds()
+        return min(max(delay, 0.5), self.max_interval)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                self.run_once()
+                if time.monotonic() - self._last_pruned_at >= CHANGE_LOG_PRUNE_INTERVAL:
+                    self._last_pruned_at = time.monotonic()
+                    prune_marker_changes()
+                if hot_markers.loaded_path and time.monotonic() - hot_markers.rebuilt_at >= HOT_SET_REFRESH_INTERVAL:
+                    hot_markers.rebuild()
+                if time.monotonic() - self._last_reconciled_at >= STATS_RECONCILE_INTERVAL:
+                    self._last_reconciled_at = time.monotonic()
+                    conn = get_db_connection()
+                    with conn:
+                        reconcile_stat_counters(conn)
+                    conn.close()
+                # Checked hourly, claim_archive_run lets one process per ARCHIVE_INTERVAL do the work
+                if time.monotonic() - self._last_archive_check_at >= CHANGE_LOG_PRUNE_INTERVAL:
+                    self._last_archive_check_at = time.monotonic()
+                    if claim_archive_run():
+                        archive_markers()
+                delay = self._seconds_until_next_expiry()
+                self.last_error = None
+            except Exception as e:
+                print(f"Expiry sweep failed: {e}")
+                self.last_error = str(e)
+                delay = self.max_interval
+            self.next_run_at = datetime.datetime.now(datetime.UTC) + datetime.timedelta(seconds=delay)
+            self._wakeup.wait(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None and self._thread.is_alive(),
+                'runs': self.runs,
+                'total_expired': self.total_expired,
+                'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+                'last_expired': self.last_expired,
+                'last_duration_ms': self.last_duration_ms,
+                'next_run_at': self.next_run_at.isoformat() if self.next_run_at else None,
+                'last_error': self.last_error,
+            }
+
+expiry_scheduler = ExpiryScheduler(EXPIRY_SWEEP_MAX_INTERVAL)
+
+class ChangeLogFollower:
+    """Background thread replaying other worker processes' marker writes to this process's listeners.
+
+    The in-process caches and the live stream broker only hear about writes made in
+    their own process. With several workers on one database, this thread tails the
+    marker_changes log and calls notify_marker_change(local=False) for every change
+    this process did not make itself. If two processes change the same marker within
+    one poll interval, the remote change is only picked up through the cache TTLs.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._local = {}  # marker id -> when this process last notified a change to it
+        self.cursor = None
+        self.polls = 0
+        self.replayed = 0
+        self.last_error = None
+
+    def start(self):
+        """Starts the follower thread once per process."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._local = {}
+            self.cursor = None
+            self._thread = threading.Thread(target=self._run, name='change-follower', daemon=True)
+            self._thread.start()
+
+    def remember(self, markers):
+        """Records markers this process changed, so their change log entries are not replayed."""
+        now = time.monotonic()
+        with self._lock:
+            for marker in markers:
+                self._local[marker['id']] = now
+
+    def poll(self):
+        conn = get_db_connection()
+        try:
+            if self.cursor is None:
+                self.cursor = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM marker_changes').fetchone()[0]
+                return 0
+            # Local changes notified before this point are committed and visible to the query
+            started = time.monotonic()
+            rows = conn.execute('''
+                SELECT c.seq AS change_seq, c.op AS change_op, c.marker_id AS change_marker_id,
+                       c.kind AS change_kind, c.snapshot AS change_snapshot, m.*
+                FROM marker_changes c
+                LEFT JOIN markers m ON m.id = c.marker_id
+                WHERE c.seq > ?
+                ORDER BY c.seq
+                LIMIT ?
+            ''', (self.cursor, CHANGES_PAGE_SIZE)).fetchall()
+        finally:
+            conn.close()
+
+        changes = []  # [kind, [marker, ...]] runs in log order
+        with self._lock:
+            for row in rows:
+                marker_id = row['change_marker_id']
+                if self._local.get(marker_id, started + 1) <= started:
+                    continue
+                if row['change_op'] == 'delete' or row['id'] is None:
+                    kind = 'deleted'
+                    # Tombstones written before the snapshot column existed only have the id
+                    marker = json.loads(row['change_snapshot']) if row['change_snapshot'] else {'id': marker_id}
+                else:
+                    kind = row['change_kind'] or 'updated'
+                    marker = {k: row[k] for k in row.keys() if not k.startswith('change_')}
+                if changes and changes[-1][0] == kind:
+                    changes[-1][1].append(marker)
+                else:
+                    changes.append([kind, [marker]])
+            self._local = {k: v for k, v in self._local.items() if v > started}
+            if rows:
+                self.cursor = rows[-1]['change_seq']
+            self.polls += 1
+            replayed = sum(len(markers) for _, markers in changes)
+            self.replayed += replayed
+        for kind, markers in changes:
+            notify_marker_change(kind, markers, local=False)
+        return replayed
+
+    def _run(self):
+        while True:
+            try:
+                # A full page means more changes are waiting, poll again right away
+                while self.poll() >= CHANGES_PAGE_SIZE:
+                    pass
+                self.last_error = None
+            except Exception as e:
+                print(f"Change log follower failed: {e}")
+                self.last_error = str(e)
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': FOLLOW_CHANGES,
+                'running': self._thread is not None and self._thread.is_alive(),
+                'cursor': self.cursor,
+                'polls': self.polls,
+                'replayed': self.replayed,
+                'last_error': self.last_error,
+            }
+
+change_follower = ChangeLogFollower(FOLLOW_CHANGES_INTERVAL)
+
+@app.before_request
+def start_background_tasks():
+    """Makes sure the background threads run, and the hot set is loaded, in this (worker) process."""
+    hot_markers.ensure_loaded()
+    expiry_scheduler.start()
+    if FOLLOW_CHANGES:
+        change_follower.start()
+
 @app.route('/api/markers/<username>', methods=['GET'])
 @login_required
 def get_user_markers(username):
@@ -163,18 +2675,63 @@ def get_user_markers(username):
     if requester_username != username:
         return jsonify({'error': 'Forbidden: You can only view your own markers.'}), 403
 
-    conn = get_db_connection()
-    # For "my-markers" page, we want to see both active and inactive markers, so we don't filter by status here.
-    # We will still filter by expiration, unless we want to show expired ones too. Let's show all for management.
-    markers_cursor = conn.execute('''
-        SELECT m.*, u.name as user_name
-        FROM markers m
-        JOIN users u ON m.user_username = u.username
-        WHERE m.user_username = ? ORDER BY m.created_at DESC
-    ''', (username,))
-    markers = [dict(row) for row in markers_cursor.fetchall()]
-    conn.close()
-    return jsonify(markers)
+    conn = get_db_connection()
+    # For "my-markers" page, we want to see both active and inactive markers, so we don't filter by status here.
+    # We will still filter by expiration, unless we want to show expired ones too. Let's show all for management.
+    markers_cursor = conn.execute(USER_MARKERS_QUERY, (username,))
+    markers = [dict(row) for row in markers_cursor.fetchall()]
+    conn.close()
+    return jsonify(markers)
+
+def prepare_new_marker(new_marker):
+    """Validates a marker submitted by a user and returns its INSERT parameters, raising ValueError if invalid."""
+    if not all(k in new_marker for k in ['title', 'description', 'marker_type', 'lat', 'lng', 'user_username']):
+        raise ValueError('Missing required fields')
+    try:
+        geohash = geohash_encode(float(new_marker['lat']), float(new_marker['lng']))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid coordinates')
+    visibility = new_marker.get('visibility', 'today')
+    return (
+        new_marker.get('title'),
+        new_marker.get('description'),
+        new_marker.get('contact', ''), # Default to empty string if not provided
+        new_marker.get('marker_type'),
+        visibility,
+        new_marker.get('lat'),
+        new_marker.get('lng'),
+        new_marker.get('user_username'),
+        compute_expires_at(visibility, datetime.datetime.now(datetime.UTC)),
+        geohash
+    )
+
+def insert_user_markers(username, markers):
+    """Creates the prepared markers of one user in a single transaction.
+
+    The active marker limit is checked under the write lock for all of them together,
+    so concurrent requests cannot exceed it. Returns the created rows, or None (and
+    creates nothing) if the markers would exceed the limit.
+    """
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            active_markers_count = conn.execute(ACTIVE_MARKER_COUNT_QUERY, (username, 'active')).fetchone()[0]
+            if active_markers_count + len(markers) > MAX_ACTIVE_MARKERS_PER_USER:
+                return None
+            created = []
+            for params in markers:
+                created.append(dict(conn.execute('''
+                    INSERT INTO markers (title, description, contact, marker_type, visibility, lat, lng, user_username, expires_at, geohash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    RETURNING *
+                ''', params).fetchone()))
+    finally:
+        conn.close()
+
+    expiry_scheduler.schedule(min(params[8] for params in markers))
+    notify_marker_change('created', created)
+    return created
 
 @app.route('/api/markers', methods=['POST'])
 @login_required
@@ -192,53 +2749,70 @@ def add_marker():
     # Security check: Ensure the user is not posting on behalf of someone else
     if user_username != requester_username:
         return jsonify({'error': 'Forbidden: You can only create markers for yourself.'}), 403
-    
-    conn = get_db_connection()
 
-    # Check active marker limit for the user
-    active_markers_count_cursor = conn.execute(
-        'SELECT COUNT(*) FROM markers WHERE user_username = ? AND status = ?',
-        (user_username, 'active')
-    )
-    active_markers_count = active_markers_count_cursor.fetchone()[0]
-    
-    if active_markers_count >= 3:
-        conn.close()
-        return jsonify({'error': 'You have reached the maximum limit of 3 active markers.'}), 403 # 403 Forbidden
+    try:
+        params = prepare_new_marker(new_marker)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    visibility = new_marker.get('visibility', 'today')
-    now = datetime.datetime.now(datetime.UTC)
-    expires_at = None
+    created = insert_user_markers(user_username, [params])
+    if created is None:
+        return jsonify({'error': f'You have reached the maximum limit of {MAX_ACTIVE_MARKERS_PER_USER} active markers.'}), 403 # 403 Forbidden
 
-    if visibility == 'today':
-        # Expires at the end of the current UTC day
-        expires_at = now.replace(hour=23, minute=59, second=59, microsecond=999999)
-    elif visibility == 'three_days':
-        expires_at = now + datetime.timedelta(days=3)
-    else:
-        # Default fallback or for old types - maybe expire in 1 year?
-        expires_at = now + datetime.timedelta(days=365)
+    return jsonify({'id': created[0]['id'], 'message': 'Marker added successfully'}), 201
 
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO markers (title, description, contact, marker_type, visibility, lat, lng, user_username, expires_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        new_marker.get('title'),
-        new_marker.get('description'),
-        new_marker.get('contact', ''), # Default to empty string if not provided
-        new_marker.get('marker_type'),
-        visibility,
-        new_marker.get('lat'),
-        new_marker.get('lng'),
-        new_marker.get('user_username'),
-        expires_at
-    ))
-    conn.commit()
-    new_id = cursor.lastrowid
-    conn.close()
+@app.route('/api/markers/batch', methods=['POST'])
+@login_required
+def add_markers_batch():
+    """API endpoint to create several markers for the requesting user in one request.
+
+    Body: {'markers': [...]}, each with the fields of add_marker. Invalid items are
+    reported in 'results' and skipped. The valid ones are created in one transaction:
+    all of them, or none if together they would exceed the active marker limit.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get('markers')
+    if not isinstance(items, list) or not 0 < len(items) <= MARKER_BATCH_MAX_SIZE:
+        return jsonify({'error': f'markers must be a list of 1 to {MARKER_BATCH_MAX_SIZE} markers'}), 400
+
+    requester_username = request.headers.get('X-User-Username')
+    results = []
+    prepared = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'index': index, 'error': 'Invalid marker'})
+            continue
+        try:
+            params = prepare_new_marker(item)
+        except ValueError as e:
+            results.append({'index': index, 'error': str(e)})
+            continue
+        if item['user_username'] != requester_username:
+            results.append({'index': index, 'error': 'Forbidden: You can only create markers for yourself.'})
+        else:
+            prepared.append((index, params))
+
+    if prepared:
+        created = insert_user_markers(requester_username, [params for _, params in prepared])
+        if created is None:
+            return jsonify({
+                'error': f'These markers would exceed the maximum limit of {MAX_ACTIVE_MARKERS_PER_USER} active markers.',
+                'results': results
+            }), 403
+        results.extend({'index': index, 'id': row['id']} for (index, _), row in zip(prepared, created))
+    results.sort(key=lambda result: result['index'])
+    return jsonify({'created': len(prepared), 'results': results}), 201 if prepared else 400
 
-    return jsonify({'id': new_id, 'message': 'Marker added successfully'}), 201
+def username_shadowed_by_route(username):
+    """Whether GET /api/markers/<username> resolves to a fixed route such as /api/markers/search.
+
+    A user with such a name could never list their markers, so it can't be registered.
+    """
+    try:
+        endpoint, _ = app.url_map.bind('localhost').match(f'/api/markers/{username}', method='GET')
+    except HTTPException:
+        return False
+    return endpoint != 'get_user_markers'
 
 @app.route('/api/register', methods=['POST'])
 def register_user():
@@ -246,6 +2820,8 @@ def register_user():
     data = request.get_json()
     if not data or not data.get('username') or not data.get('email') or not data.get('password'):
         return jsonify({'error': 'Missing required fields'}), 400
+    if username_shadowed_by_route(data['username']):
+        return jsonify({'error': 'This username is reserved'}), 400
 
     username = data['username']
     email = data['email']
@@ -260,6 +2836,7 @@ def register_user():
         )
         conn.commit()
         user_id = cursor.lastrowid
+        invalidate_cached_user(username)  # Drop a cached 'user not found' entry
         return jsonify({'id': user_id, 'message': 'User registered successfully'}), 201
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Username or email already exists'}), 409 # 409 Conflict
@@ -278,10 +2855,7 @@ def login_user():
 
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM users WHERE (username = ? OR email = ?) AND password = ?",
-        (identifier, identifier, password)
-    )
+    cursor.execute(LOGIN_QUERY, (identifier, identifier, password))
     user_row = cursor.fetchone()
     conn.close()
 
@@ -305,7 +2879,9 @@ def get_user_profile(username):
     conn.close()
 
     if user:
-        return jsonify(dict(user))
+        profile = dict(user)
+        profile['avatar_urls'] = avatar_rendition_urls(profile['avatar_url'])
+        return jsonify(profile)
     else:
         return jsonify({'error': 'User not found'}), 404
 
@@ -342,6 +2918,10 @@ def update_profile():
             tuple(values)
         )
         conn.commit()
+        invalidate_cached_user(username)
+        if 'name' in update_fields:
+            hot_markers.rename_user(username, update_fields['name'])
+            marker_data_version.bump()  # user_name is part of the marker feed
         if cursor.rowcount == 0:
             return jsonify({'error': 'User not found'}), 404
         return jsonify({'message': 'Profile updated successfully'}), 200
@@ -374,19 +2954,355 @@ def update_marker_status(marker_id):
         return jsonify({'error': 'Forbidden: You can only update your own markers.'}), 403
 
     cursor = conn.cursor()
-    cursor.execute('UPDATE markers SET status = ? WHERE id = ?', (new_status, marker_id))
+    cursor.execute('UPDATE markers SET status = ? WHERE id = ? RETURNING *', (new_status, marker_id))
+    updated = cursor.fetchall()
     conn.commit()
     
-    if cursor.rowcount == 0:
+    if not updated:
         conn.close()
         return jsonify({'error': 'Marker not found'}), 404
 
     conn.close()
+    notify_marker_change('status', [dict(row) for row in updated])
     return jsonify({'message': f'Marker {marker_id} status updated to {new_status}'}), 200
 
+@app.route('/api/markers/batch/status', methods=['PUT'])
+@login_required
+def update_markers_status_batch():
+    """API endpoint to set the status (active/inactive) of several of the user's markers at once.
+
+    Body: {'ids': [...], 'status': 'active' | 'inactive'}. Ownership is checked with one
+    query and all owned markers are updated in one transaction. Activations that would
+    take the user past MAX_ACTIVE_MARKERS_PER_USER active markers are rejected, in the
+    order of ids. 'results' reports each id as updated or with its error.
+    """
+    data = request.get_json(silent=True) or {}
+    new_status = data.get('status')
+    if new_status not in ['active', 'inactive']:
+        return jsonify({'error': 'Invalid status value'}), 400
+    ids = data.get('ids')
+    if (not isinstance(ids, list) or not 0 < len(ids) <= MARKER_BATCH_MAX_SIZE
+            or not all(isinstance(marker_id, int) for marker_id in ids)):
+        return jsonify({'error': f'ids must be a list of 1 to {MARKER_BATCH_MAX_SIZE} marker ids'}), 400
+    ids = list(dict.fromkeys(ids))
+
+    requester_username = request.headers.get('X-User-Username')
+    placeholders = ', '.join('?' for _ in ids)
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = {row['id']: row for row in conn.execute(
+                f'SELECT id, user_username, status FROM markers WHERE id IN ({placeholders})', tuple(ids)
+            )}
+            owners = {marker_id: row['user_username'] for marker_id, row in rows.items()}
+            owned = [marker_id for marker_id in ids if owners.get(marker_id) == requester_username]
+            over_limit = set()
+            if new_status == 'active':
+                # Counted under the write lock, like insert_user_markers
+                active_markers_count = conn.execute(
+                    ACTIVE_MARKER_COUNT_QUERY, (requester_username, 'active')
+                ).fetchone()[0]
+                for marker_id in owned:
+                    if rows[marker_id]['status'] == 'active':
+                        continue
+                    if active_markers_count >= MAX_ACTIVE_MARKERS_PER_USER:
+                        over_limit.add(marker_id)
+                    else:
+                        active_markers_count += 1
+                owned = [marker_id for marker_id in owned if marker_id not in over_limit]
+            updated = []
+            if owned:
+                updated = [dict(row) for row in conn.execute(
+                    f"UPDATE markers SET status = ? WHERE id IN ({', '.join('?' for _ in owned)}) RETURNING *",
+                    (new_status, *owned)
+                )]
+    finally:
+        conn.close()
+
+    if updated:
+        notify_marker_change('status', updated)
+    results = []
+    for marker_id in ids:
+        if marker_id not in owners:
+            results.append({'id': marker_id, 'error': 'Marker not found'})
+        elif owners[marker_id] != requester_username:
+            results.append({'id': marker_id, 'error': 'Forbidden: You can only update your own markers.'})
+        elif marker_id in over_limit:
+            results.append({'id': marker_id, 'error': f'You have reached the maximum limit of {MAX_ACTIVE_MARKERS_PER_USER} active markers.'})
+        else:
+            results.append({'id': marker_id, 'status': new_status})
+    return jsonify({'updated': len(updated), 'results': results}), 200
+
+def process_avatar(source_path, dest_dir, base_filename, sizes):
+    """Crops an uploaded image to a square and writes one JPEG rendition per size.
+
+    Runs in an avatar worker process. Large JPEGs are decoded at a reduced scale via
+    draft(), and each smaller rendition is resized from the previous one, so a single
+    decode serves every size. Returns the rendition filenames and the processing times.
+    """
+    started = time.time()
+    largest = max(sizes)
+    filenames = {}
+    with Image.open(source_path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (largest, largest))  # Let libjpeg downscale while decoding
+        decoded = time.time()
+
+        # Crop the image to a square from the center
+        width, height = img.size
+        if width != height:
+            short_dim = min(width, height)
+            left = (width - short_dim) / 2
+            top = (height - short_dim) / 2
+            right = (width + short_dim) / 2
+            bottom = (height + short_dim) / 2
+            img = img.crop((left, top, right, bottom))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        rendition = img
+        for size in sorted(sizes, reverse=True):
+            rendition = rendition.resize((size, size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            filename = f"{base_filename}_{size}.jpg"
+            # Write then rename so a concurrent identical upload never serves a partial file
+            tmp_path = os.path.join(dest_dir, f"{filename}.{os.getpid()}.tmp")
+            rendition.save(tmp_path, 'JPEG', quality=90, optimize=True)
+            os.replace(tmp_path, os.path.join(dest_dir, filename))
+            filenames[size] = filename
+    finished = time.time()
+    return {
+        'filenames': filenames,
+        'started_at': started,
+        'decode_ms': round((decoded - started) * 1000, 3),
+        'processing_ms': round((finished - started) * 1000, 3),
+    }
+
+def avatar_rendition_urls(avatar_url):
+    """Returns {size: url} for an avatar produced by process_avatar, or {} for legacy avatars."""
+    if not avatar_url:
+        return {}
+    base, _, suffix = avatar_url.rpartition('_')
+    if suffix not in {f'{size}.jpg' for size in AVATAR_SIZES}:
+        return {}
+    return {size: f'{base}_{size}.jpg' for size in AVATAR_SIZES}
+
+def avatar_files_exist(avatar_url):
+    return all(
+        os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(url)))
+        for url in avatar_rendition_urls(avatar_url).values()
+    )
+
+# Serializes the reference check in collect_avatar_files with deduplicated uploads
+avatar_gc_lock = threading.Lock()
+
+def collect_avatar_files(avatar_url):
+    """Deletes every rendition of an avatar once no user references it anymore.
+
+    Avatars are content-addressed and shared between users who uploaded the same
+    image, so the files are only removed when their reference count drops to zero.
+    """
+    if not avatar_url:
+        return
+    with avatar_gc_lock:
+        if avatar_jobs.is_in_flight(avatar_url):
+            return  # A queued job is writing these files and will point a user at them
+        conn = get_db_connection()
+        references = conn.execute('SELECT COUNT(*) FROM users WHERE avatar_url = ?', (avatar_url,)).fetchone()[0]
+        conn.close()
+        if references > 0:
+            return
+        urls = list(avatar_rendition_urls(avatar_url).values()) or [avatar_url]
+        for url in urls:
+            path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(url))
+            if os.path.exists(path):
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    print(f"Error deleting old avatar file: {e}")
+
+class AvatarJobQueue:
+    """Runs avatar processing in a bounded process pool and tracks job status for polling.
+
+    Only a user's most recent upload is applied. An older job that finishes after it
+    is marked 'superseded' and changes neither the user's avatar nor any files.
+    """
+
+    def __init__(self, workers, max_pending, history):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._latest = {}  # username -> id of the user's most recently submitted job
+        self._in_flight = {}  # avatar_url -> number of accepted jobs that have not finished
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.superseded = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Never fork: this process runs request and background threads whose locks the child would inherit
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver')
+            )
+        return self._executor
+
+    def submit(self, username, source_path, base_filename):
+        """Queues a job, returns it or None if the queue is full.
+
+        If the renditions of this exact image already exist the job completes
+        immediately without processing anything.
+        """
+        job = {
+            'id': uuid.uuid4().hex,
+            'username': username,
+            'status': 'queued',
+            'avatar_url': f'/uploads/avatars/{base_filename}_{max(AVATAR_SIZES)}.jpg',
+            'error': None,
+            'queued_at': time.time(),
+            'timings': None,
+        }
+        with avatar_gc_lock:
+            if avatar_files_exist(job['avatar_url']):
+                with self._lock:
+                    self._latest[username] = job['id']
+                old_avatar_url = self._apply_if_latest(job)
+                job['timings'] = {'deduplicated': True}
+        if job['status'] != 'queued':
+            os.remove(source_path)
+            collect_avatar_files(old_avatar_url)
+            with self._lock:
+                self.deduplicated += 1
+                self._remember(job)
+                self._forget_latest(job)
+            return job
+
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return None
+            # Only an accepted job supersedes the user's earlier ones
+            self._latest[username] = job['id']
+            self._in_flight[job['avatar_url']] = self._in_flight.get(job['avatar_url'], 0) + 1
+            self.pending += 1
+            self._remember(job)
+            executor = self._get_executor()
+        future = executor.submit(process_avatar, source_path, app.config['UPLOAD_FOLDER'], base_filename, AVATAR_SIZES)
+        future.add_done_callback(lambda f: self._finish(job, source_path, f))
+        return job
+
+    def _remember(self, job):
+        self._jobs[job['id']] = job
+        while len(self._jobs) > self.history:
+            self._jobs.popitem(last=False)
+
+    def is_in_flight(self, avatar_url):
+        """Whether an accepted job for avatar_url is still processing, its files must not be collected."""
+        with self._lock:
+            return avatar_url in self._in_flight
+
+    def _forget_latest(self, job):
+        if self._latest.get(job['username']) == job['id']:
+            del self._latest[job['username']]
+
+    def _apply_if_latest(self, job):
+        """Applies a finished job unless a newer one was submitted for the user, and sets its status.
+
+        Returns the avatar_url to collect, if any. The caller holds avatar_gc_lock.
+        """
+        with self._lock:
+            latest = self._latest.get(job['username']) == job['id']
+            if not latest:
+                self.superseded += 1
+        if not latest:
+            job['status'] = 'superseded'
+            return None
+        job['status'] = 'done'
+        return self._apply(job)
+
+    def _apply(self, job):
+        """Points the user at the job's avatar and returns the previous avatar_url, if any."""
+        conn = get_db_connection()
+        old_avatar_row = conn.execute('SELECT avatar_url FROM users WHERE username = ?', (job['username'],)).fetchone()
+        conn.execute('UPDATE users SET avatar_url = ? WHERE username = ?', (job['avatar_url'], job['username']))
+        conn.commit()
+        conn.close()
+        invalidate_cached_user(job['username'])
+        if old_avatar_row and old_avatar_row['avatar_url'] != job['avatar_url']:
+            return old_avatar_row['avatar_url']
+        return None
+
+    def _finish(self, job, source_path, future):
+        try:
+            result = future.result()
+            with avatar_gc_lock:
+                if not avatar_files_exist(job['avatar_url']):
+                    raise RuntimeError('the processed files were removed, please upload the image again')
+                old_avatar_url = self._apply_if_latest(job)
+            collect_avatar_files(old_avatar_url)
+
+            finished = time.time()
+            job['timings'] = {
+                'queued_ms': round((result['started_at'] - job['queued_at']) * 1000, 3),
+                'decode_ms': result['decode_ms'],
+                'processing_ms': result['processing_ms'],
+                'total_ms': round((finished - job['queued_at']) * 1000, 3),
+            }
+            with self._lock:
+                self.completed += 1
+        except Exception as e:
+            print(f"Avatar processing failed for {job['username']}: {e}")
+            job['status'] = 'failed'
+            job['error'] = f'Image processing failed: {str(e)}'
+            with self._lock:
+                self.failed += 1
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self._forget_latest(job)
+                self._in_flight[job['avatar_url']] -= 1
+                if not self._in_flight[job['avatar_url']]:
+                    del self._in_flight[job['avatar_url']]
+            try:
+                os.remove(source_path)
+            except OSError:
+                pass
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            recent = [job['timings'] for job in self._jobs.values() if job['timings']][-20:]
+            return {
+                'workers': self.workers,
+                'queue_depth': self.pending,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'deduplicated': self.deduplicated,
+                'superseded': self.superseded,
+                'recent_timings': recent,
+            }
+
+avatar_jobs = AvatarJobQueue(AVATAR_WORKERS, AVATAR_MAX_PENDING, AVATAR_JOB_HISTORY)
+
 @app.route('/api/profile/avatar', methods=['POST'])
 @login_required
 def upload_avatar():
+    """API endpoint to upload an avatar. Image processing happens in the background.
+
+    Responds with 202 and a job whose status can be polled at status_url. Once the job
+    is done the user's avatar_url points to the largest rendition, smaller renditions
+    are listed in avatar_urls.
+    """
     username = request.headers.get('X-User-Username')
     
     if 'avatar' not in request.files:
@@ -398,71 +3314,64 @@ def upload_avatar():
         return jsonify({'error': 'No file selected'}), 400
         
     if file and allowed_file(file.filename):
-        # Get old avatar URL to delete the file later
-        conn = get_db_connection()
-        old_avatar_row = conn.execute('SELECT avatar_url FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
-
-        # Create a unique filename based on username and timestamp, ensuring it's a .jpg
-        timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        base_filename = f"{username}_{timestamp}"
-        new_filename = f"{base_filename}.jpg"
-        
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
-
-        try:
-            with Image.open(file.stream) as img:
-                # Crop the image to a square from the center
-                width, height = img.size
-                if width != height:
-                    short_dim = min(width, height)
-                    left = (width - short_dim) / 2
-                    top = (height - short_dim) / 2
-                    right = (width + short_dim) / 2
-                    bottom = (height + short_dim) / 2
-                    img = img.crop((left, top, right, bottom))
-                
-                # Resize to 800x800 and convert to RGB
-                img_resized = img.resize((800, 800), Image.Resampling.LANCZOS)
-                if img_resized.mode != 'RGB':
-                    img_resized = img_resized.convert('RGB')
-                
-                img_resized.save(file_path, 'JPEG', quality=90)
-        except Exception as e:
-            return jsonify({'error': f'Image processing failed: {str(e)}'}), 500
-        
-        avatar_url = f'/uploads/avatars/{new_filename}'
-
-        # Update the database
-        conn = get_db_connection()
-        conn.execute('UPDATE users SET avatar_url = ? WHERE username = ?', (avatar_url, username))
-        conn.commit()
-        conn.close()
+        # Hand the upload to the worker process through a temporary file, hashing it on the way.
+        # Avatars are named after the content hash so identical uploads share their files.
+        pending_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'pending')
+        os.makedirs(pending_folder, exist_ok=True)
+        source_path = os.path.join(pending_folder, f"{uuid.uuid4().hex}.upload")
+        digest = hashlib.sha256()
+        with open(source_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(65536), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        base_filename = digest.hexdigest()[:32]
 
-        # Delete the old avatar file if it existed
-        if old_avatar_row and old_avatar_row['avatar_url']:
-            # Construct absolute path for the old file to ensure it's found correctly
-            old_avatar_path_rel = old_avatar_row['avatar_url'].lstrip('/\\')
-            old_avatar_path_abs = os.path.join(os.path.dirname(os.path.abspath(__file__)), old_avatar_path_rel)
-            if os.path.exists(old_avatar_path_abs):
-                try:
-                    os.remove(old_avatar_path_abs)
-                except Exception as e:
-                    print(f"Error deleting old avatar file: {e}")
+        job = avatar_jobs.submit(username, source_path, base_filename)
+        if job is None:
+            os.remove(source_path)
+            response = jsonify({'error': 'Avatar processing is busy, please retry shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
 
-        return jsonify({'message': 'Avatar updated successfully', 'avatar_url': avatar_url}), 200
+        return jsonify({
+            'message': 'Avatar updated successfully' if job['status'] == 'done' else 'Avatar upload accepted for processing',
+            'job_id': job['id'],
+            'status': job['status'],
+            'status_url': f"/api/profile/avatar/jobs/{job['id']}",
+            'avatar_url': job['avatar_url'],
+            'avatar_urls': avatar_rendition_urls(job['avatar_url'])
+        }), 200 if job['status'] == 'done' else 202
     else:
         return jsonify({'error': 'File type not allowed'}), 400
 
+@app.route('/api/profile/avatar/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_avatar_job(job_id):
+    """API endpoint to poll the status of an avatar processing job."""
+    job = avatar_jobs.get(job_id)
+    if job is None or job['username'] != request.headers.get('X-User-Username'):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'error': job['error'],
+        'avatar_url': job['avatar_url'],
+        'avatar_urls': avatar_rendition_urls(job['avatar_url']),
+        'timings': job['timings']
+    })
+
 # --- File Serving ---
 
 @app.route('/uploads/avatars/<filename>')
 def uploaded_avatar(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-
-# Initialize the database when the app starts
-init_db()
+    # Files are sent with ETag/Last-Modified and Range support, through the
+    # server's sendfile wrapper when it provides one.
+    if not CONTENT_ADDRESSED_AVATAR.match(filename):
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)  # Legacy username_timestamp.jpg
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename, max_age=AVATAR_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 # --- Admin-specific logic ---
 
@@ -481,31 +3390,106 @@ def admin_required(f):
         except:
             pass  # 如果解码失败，使用原始值
 
-        conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ? AND role = ?', 
-                            (admin_username, 'admin')).fetchone()
-        conn.close()
+        user = get_cached_user(admin_username)
 
-        if user is None:
+        if user is None or user['role'] != 'admin':
             return jsonify({"error": "Unauthorized: Not an admin"}), 403
         
         return f(*args, **kwargs)
     return decorated_function
 
+def stream_rows(query, params, output_format):
+    """Streams query results as a JSON array or as NDJSON without buffering all rows.
+
+    The connection is acquired inside the generator because the request context (and
+    with it release_db_connections) is torn down before the body is consumed.
+    """
+    def generate():
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(query, params)
+            first = True
+            if output_format != 'ndjson':
+                yield '['
+            while True:
+                rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+                if not rows:
+                    break
+                if output_format == 'ndjson':
+                    yield ''.join(app.json.dumps(dict(row)) + '\n' for row in rows)
+                else:
+                    chunk = ','.join(app.json.dumps(dict(row)) for row in rows)
+                    yield chunk if first else ',' + chunk
+                    first = False
+            if output_format != 'ndjson':
+                yield ']'
+        finally:
+            conn.close()
+
+    mimetype = 'application/x-ndjson' if output_format == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
+
+def admin_list_response(key, query, where, params, order_by, alias):
+    """Builds the response for an admin list endpoint with keyset pagination and streaming.
+
+    Query parameters:
+        limit, after: keyset pagination over (created_at, id), newest first. 'after' is the
+            'next_after' value of the previous page.
+        format: 'json' (default) or 'ndjson'.
+
+    Unpaginated results and NDJSON are streamed straight from the cursor. A paginated
+    JSON request returns {key: [...], 'next_after': cursor or null}.
+    """
+    try:
+        after = parse_keyset_cursor(request.args['after']) if request.args.get('after') else None
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'ndjson'):
+        return jsonify({'error': 'format must be json or ndjson'}), 400
+
+    where = list(where)
+    params = list(params)
+    if after is not None:
+        where.append(f'({alias}.created_at, {alias}.id) < (?, ?)')
+        params.extend(after)
+        limit = limit or ADMIN_PAGE_SIZE
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += f' ORDER BY {order_by}'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    if limit is None or output_format == 'ndjson':
+        return stream_rows(query, tuple(params), output_format)
+
+    conn = get_db_connection()
+    rows = [dict(row) for row in conn.execute(query, tuple(params)).fetchall()]
+    conn.close()
+    next_after = f"{rows[-1]['created_at']},{rows[-1]['id']}" if len(rows) == limit else None
+    return jsonify({key: rows, 'next_after': next_after})
+
 @app.route('/api/admin/all-markers', methods=['GET'])
 @admin_required
 def get_all_markers():
-    """Admin endpoint to get all markers, regardless of status or expiration."""
-    conn = get_db_connection()
-    markers_cursor = conn.execute('''
+    """Admin endpoint to get all markers, regardless of status or expiration.
+
+    Supports the status, marker_type and username filters plus the pagination and
+    streaming parameters of admin_list_response.
+    """
+    where, params = [], []
+    for arg, column in [('status', 'm.status'), ('marker_type', 'm.marker_type'), ('username', 'm.user_username')]:
+        if request.args.get(arg):
+            where.append(f'{column} = ?')
+            params.append(request.args[arg])
+    query = '''
         SELECT m.*, u.name as user_name
         FROM markers m
         JOIN users u ON m.user_username = u.username
-        ORDER BY m.created_at DESC
-    ''')
-    markers = [dict(row) for row in markers_cursor.fetchall()]
-    conn.close()
-    return jsonify(markers)
+    '''
+    return admin_list_response('markers', query, where, params, 'm.created_at DESC, m.id DESC', 'm')
 
 @app.route('/api/admin/markers/<int:marker_id>', methods=['PUT'])
 @admin_required
@@ -526,14 +3510,16 @@ def admin_update_marker(marker_id):
 
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(f"UPDATE markers SET {set_clause} WHERE id = ?", tuple(values))
+    cursor.execute(f"UPDATE markers SET {set_clause} WHERE id = ? RETURNING *", tuple(values))
+    updated = cursor.fetchall()
     conn.commit()
 
-    if cursor.rowcount == 0:
+    if not updated:
         conn.close()
         return jsonify({'error': 'Marker not found'}), 404
 
     conn.close()
+    notify_marker_change('updated', [dict(row) for row in updated])
     return jsonify({'message': f'Marker {marker_id} updated successfully by admin.'}), 200
 
 @app.route('/api/admin/markers/<int:marker_id>', methods=['DELETE'])
@@ -542,52 +3528,131 @@ def admin_delete_marker(marker_id):
     """Admin endpoint to delete any marker."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM markers WHERE id = ?', (marker_id,))
+    cursor.execute('DELETE FROM markers WHERE id = ? RETURNING *', (marker_id,))
+    deleted = cursor.fetchall()
     conn.commit()
 
-    if cursor.rowcount == 0:
+    if not deleted:
         conn.close()
         return jsonify({'error': 'Marker not found'}), 404
         
     conn.close()
+    notify_marker_change('deleted', [dict(row) for row in deleted])
     return jsonify({'message': f'Marker {marker_id} deleted successfully by admin.'}), 200
 
 @app.route('/api/admin/stats', methods=['GET'])
 @admin_required
 def get_admin_stats():
-    """Admin endpoint to get various statistics for the dashboard."""
-    conn = get_db_connection()
-    total_markers = conn.execute('SELECT COUNT(*) FROM markers').fetchone()[0]
-    total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    
-    # Calculate daily new markers
-    today_start = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-    daily_new_markers = conn.execute('SELECT COUNT(*) FROM markers WHERE created_at >= ?', (today_start,)).fetchone()[0]
-    
-    # Calculate expired markers (those that have passed their expiration time)
+    """Admin endpoint to get various statistics for the dashboard.
+
+    All numbers come from the trigger-maintained stat_counters and marker_daily_stats
+    tables. The optional 'days' parameter (default 30) sets the length of the
+    daily_series of markers created per UTC day.
+    """
+    try:
+        days = min(int(request.args.get('days', 30)), STATS_MAX_DAYS)
+        if days < 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid days parameter'}), 400
+
     now = datetime.datetime.now(datetime.UTC)
-    expired_markers = conn.execute('SELECT COUNT(*) FROM markers WHERE expires_at <= ?', (now,)).fetchone()[0]
+    today = now.date()
+    conn = get_db_connection()
+    counters = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM stat_counters')}
+
+    # Add the markers that expired since the scheduler last advanced the watermark
+    expired_since_watermark = conn.execute('''
+        SELECT COUNT(*) FROM markers
+        WHERE expires_at > (SELECT value FROM app_meta WHERE key = 'expired_watermark') AND expires_at <= ?
+    ''', (now,)).fetchone()[0]
 
+    first_day = (today - datetime.timedelta(days=max(days - 1, 0))).isoformat()
+    created_per_day = {
+        row['day']: row['created']
+        for row in conn.execute('SELECT day, created FROM marker_daily_stats WHERE day >= ?', (first_day,))
+    }
     conn.close()
+
+    daily_series = []
+    for offset in range(days - 1, -1, -1):
+        day = (today - datetime.timedelta(days=offset)).isoformat()
+        daily_series.append({'day': day, 'created': created_per_day.get(day, 0)})
+
+    def breakdown(prefix):
+        return {name[len(prefix):]: value for name, value in counters.items() if name.startswith(prefix) and value}
+
+    return jsonify({
+        'total_markers': counters.get('markers_total', 0),
+        'total_users': counters.get('users_total', 0),
+        'daily_new_markers': created_per_day.get(today.isoformat(), 0),
+        'expired_markers': counters.get('markers_expired', 0) + expired_since_watermark,
+        'markers_by_type': breakdown('markers_type:'),
+        'markers_by_status': breakdown('markers_status:'),
+        'daily_series': daily_series
+    })
+
+@app.route('/api/admin/runtime-stats', methods=['GET'])
+@admin_required
+def get_runtime_stats():
+    """Admin endpoint exposing in-process runtime statistics for monitoring."""
     return jsonify({
-        'total_markers': total_markers,
-        'total_users': total_users,
-        'daily_new_markers': daily_new_markers,
-        'expired_markers': expired_markers
+        'db_pool': db_pool.stats(),
+        'expiry_scheduler': expiry_scheduler.stats(),
+        'user_cache': user_cache.stats(),
+        'marker_feed': dict(marker_feed_cache.stats(), data_version=marker_data_version.value),
+        'tile_cache': tile_cache.stats(),
+        'avatar_jobs': avatar_jobs.stats(),
+        'bulk_transfers': bulk_transfer_stats,
+        'marker_events': marker_events.stats(),
+        'change_follower': change_follower.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'admission': admission.stats(),
+        'hot_markers': hot_markers.stats(),
+        'archive': archive_stats
     })
 
+@app.route('/api/admin/metrics', methods=['GET'])
+@admin_required
+def get_metrics():
+    """Admin endpoint exposing request and query metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/metrics/profiles', methods=['GET'])
+@admin_required
+def list_request_profiles():
+    """Admin endpoint listing the ids and request lines of the recent request profiles."""
+    with metrics._lock:
+        profiles = [{'id': k, 'request': v.split('\n', 1)[0]} for k, v in metrics.profiles.items()]
+    return jsonify({'profiles': profiles[::-1]})
+
+@app.route('/api/admin/metrics/profiles/<profile_id>', methods=['GET'])
+@admin_required
+def get_request_profile(profile_id):
+    """Admin endpoint returning a cProfile report of a request sent with 'X-Profile: 1'."""
+    report = metrics.profiles.get(profile_id)
+    if report is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return Response(report, mimetype='text/plain')
+
 # --- User Management by Admin ---
 
 @app.route('/api/admin/all-users', methods=['GET'])
 @admin_required
 def get_all_users():
-    """Admin endpoint to get all users."""
-    conn = get_db_connection()
+    """Admin endpoint to get all users.
+
+    Supports the role and username filters plus the pagination and streaming
+    parameters of admin_list_response.
+    """
+    where, params = [], []
+    for arg, column in [('role', 'u.role'), ('username', 'u.username')]:
+        if request.args.get(arg):
+            where.append(f'{column} = ?')
+            params.append(request.args[arg])
     # Selecting fields, excluding password
-    users_cursor = conn.execute('SELECT id, username, email, name, contact, role, created_at, avatar_url FROM users ORDER BY created_at DESC')
-    users = [dict(row) for row in users_cursor.fetchall()]
-    conn.close()
-    return jsonify(users)
+    query = 'SELECT u.id, u.username, u.email, u.name, u.contact, u.role, u.created_at, u.avatar_url FROM users u'
+    return admin_list_response('users', query, where, params, 'u.created_at DESC, u.id DESC', 'u')
 
 @app.route('/api/admin/users/<int:user_id>', methods=['PUT'])
 @admin_required
@@ -630,7 +3695,14 @@ def admin_update_user(user_id):
         conn.close()
         return jsonify({'error': 'User not found'}), 404
 
+    updated_user = conn.execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
     conn.close()
+    if updated_user:
+        invalidate_cached_user(updated_user['username'])
+        if 'name' in update_fields:
+            hot_markers.rename_user(updated_user['username'], update_fields['name'])
+    if 'name' in update_fields:
+        marker_data_version.bump()  # user_name is part of the marker feed
     return jsonify({'message': f'User {user_id} updated successfully by admin.'}), 200
 
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
@@ -640,7 +3712,7 @@ def admin_delete_user(user_id):
     admin_username = unquote(request.headers.get('X-Admin-Username'))
     
     conn = get_db_connection()
-    user_to_delete = conn.execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
+    user_to_delete = conn.execute('SELECT username, avatar_url FROM users WHERE id = ?', (user_id,)).fetchone()
     
     if not user_to_delete:
         conn.close()
@@ -651,14 +3723,561 @@ def admin_delete_user(user_id):
         return jsonify({'error': 'Admin cannot delete themselves.'}), 403
 
     # Also delete user's markers to maintain database integrity
-    conn.execute('DELETE FROM markers WHERE user_username = ?', (user_to_delete['username'],))
+    deleted_markers = conn.execute(
+        'DELETE FROM markers WHERE user_username = ? RETURNING *', (user_to_delete['username'],)
+    ).fetchall()
+    conn.execute('DELETE FROM markers_archive WHERE user_username = ?', (user_to_delete['username'],))
     cursor = conn.cursor()
     cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
 
     conn.close()
+    invalidate_cached_user(user_to_delete['username'])
+    collect_avatar_files(user_to_delete['avatar_url'])
+    if deleted_markers:
+        notify_marker_change('deleted', [dict(row) for row in deleted_markers])
     return jsonify({'message': f'User {user_id} and their markers deleted successfully by admin.'}), 200
 
+# --- Bulk Import/Export ---
+
+MARKER_EXPORT_FIELDS = [
+    'id', 'title', 'description', 'contact', 'marker_type', 'visibility',
+    'lat', 'lng', 'user_username', 'created_at', 'expires_at', 'status'
+]
+bulk_transfer_stats = {'last_import': None, 'last_export': None, 'last_moderation': None}
+
+def read_marker_records(stream, input_format):
+    """Incrementally parses an NDJSON or CSV text stream into (line_number, record) pairs.
+
+    Lines that cannot be parsed are yielded with a None record.
+    """
+    if input_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+def validate_marker_record(record, now):
+    """Turns an imported record into an INSERT parameter tuple, raising ValueError if it is invalid."""
+    missing = [k for k in ['title', 'description', 'marker_type', 'lat', 'lng', 'user_username'] if record.get(k) in (None, '')]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    lat, lng = float(record['lat']), float(record['lng'])
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError('lat/lng out of range')
+    status = record.get('status') or 'active'
+    if status not in ('active', 'inactive'):
+        raise ValueError('invalid status')
+    visibility = record.get('visibility') or 'today'
+    # Stored in UTC like the markers created through the API, the SQL filters compare them as strings
+    if record.get('expires_at'):
+        expires_at = parse_timestamp(record['expires_at']).astimezone(datetime.UTC)
+    else:
+        expires_at = compute_expires_at(visibility, now)
+    created_at = None
+    if record.get('created_at'):
+        created_at = parse_timestamp(record['created_at']).astimezone(datetime.UTC).strftime('%Y-%m-%d %H:%M:%S')
+    return (
+        record['title'], record['description'], record.get('contact') or '', record['marker_type'],
+        visibility, lat, lng, record['user_username'], created_at, expires_at, status, geohash_encode(lat, lng)
+    )
+
+def import_markers(records, batch_size=IMPORT_BATCH_SIZE):
+    """Validates and inserts marker records in batches, one executemany and transaction per batch.
+
+    Returns a summary with the imported and rejected counts, the first rejected rows
+    and the throughput. Records referencing unknown users are rejected.
+    """
+    started = time.perf_counter()
+    now = datetime.datetime.now(datetime.UTC)
+    imported = 0
+    rejected = 0
+    errors = []
+    known_users = {}
+    conn = get_db_connection()
+
+    def reject(line_number, message):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({'line': line_number, 'error': message})
+
+    def flush(batch):
+        nonlocal imported
+        with conn:
+            # Take the write lock before reading the maximum id, so every id above it is ours
+            conn.execute('BEGIN IMMEDIATE')
+            last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM markers').fetchone()[0]
+            conn.executemany('''
+                INSERT INTO markers (title, description, contact, marker_type, visibility, lat, lng,
+                                     user_username, created_at, expires_at, status, geohash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?)
+            ''', batch)
+            created = [dict(row) for row in conn.execute('SELECT * FROM markers WHERE id > ?', (last_id,))]
+        imported += len(batch)
+        notify_marker_change('created', created)
+
+    try:
+        batch = []
+        for line_number, record in records:
+            if record is None:
+                reject(line_number, 'unparseable row')
+                continue
+            try:
+                row = validate_marker_record(record, now)
+            except (ValueError, TypeError) as e:
+                reject(line_number, str(e))
+                continue
+            username = row[7]
+            if username not in known_users:
+                known_users[username] = conn.execute(
+                    'SELECT 1 FROM users WHERE username = ?', (username,)
+                ).fetchone() is not None
+            if not known_users[username]:
+                reject(line_number, f'unknown user {username}')
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    finally:
+        conn.close()
+
+    expiry_scheduler.schedule(now)  # Imported markers may already be expired
+    duration = time.perf_counter() - started
+    summary = {
+        'imported': imported,
+        'rejected': rejected,
+        'errors': errors,
+        'batch_size': batch_size,
+        'duration_s': round(duration, 3),
+        'rows_per_second': round(imported / duration, 1) if duration > 0 else None,
+    }
+    bulk_transfer_stats['last_import'] = {k: v for k, v in summary.items() if k != 'errors'}
+    print(f"Imported {imported} markers ({rejected} rejected) in {duration:.2f}s")
+    return summary
+
+def export_markers(output_format, where=(), params=()):
+    """Yields markers as NDJSON or CSV text chunks, streaming straight from the cursor."""
+    started = time.perf_counter()
+    exported = 0
+    query = f"SELECT {', '.join(MARKER_EXPORT_FIELDS)} FROM markers"
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY id'
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(query, tuple(params))
+        if output_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(MARKER_EXPORT_FIELDS)
+            yield buffer.getvalue()
+        while True:
+            rows = cursor.fetchmany(STREAM_FETCH_SIZE)
+            if not rows:
+                break
+            exported += len(rows)
+            if output_format == 'csv':
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(tuple(row) for row in rows)
+                yield buffer.getvalue()
+            else:
+                yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+    finally:
+        conn.close()
+        duration = time.perf_counter() - started
+        bulk_transfer_stats['last_export'] = {
+            'exported': exported,
+            'duration_s': round(duration, 3),
+            'rows_per_second': round(exported / duration, 1) if duration > 0 else None,
+        }
+        print(f"Exported {exported} markers in {duration:.2f}s")
+
+@app.route('/api/admin/markers/export', methods=['GET'])
+@admin_required
+def admin_export_markers():
+    """Admin endpoint streaming markers as NDJSON (default) or CSV.
+
+    Supports the status, marker_type and username filters. Throughput is logged and
+    reported in /api/admin/runtime-stats.
+    """
+    output_format = request.args.get('format', 'ndjson')
+    if output_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    where, params = [], []
+    for arg, column in [('status', 'status'), ('marker_type', 'marker_type'), ('username', 'user_username')]:
+        if request.args.get(arg):
+            where.append(f'{column} = ?')
+            params.append(request.args[arg])
+    mimetype = 'text/csv' if output_format == 'csv' else 'application/x-ndjson'
+    response = Response(export_markers(output_format, where, params), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=markers.{output_format}'
+    return response
+
+@app.route('/api/admin/markers/import', methods=['POST'])
+@admin_required
+def admin_import_markers():
+    """Admin endpoint importing markers from an NDJSON (default) or CSV request body.
+
+    The body is parsed incrementally and valid rows are inserted in transactions of
+    batch_size rows (default IMPORT_BATCH_SIZE). Imported markers get new ids.
+    """
+    input_format = request.args.get('format', 'ndjson')
+    if input_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    try:
+        batch_size = min(int(request.args.get('batch_size', IMPORT_BATCH_SIZE)), IMPORT_MAX_BATCH_SIZE)
+        if batch_size < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Invalid batch_size'}), 400
+
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='' if input_format == 'csv' else None)
+    summary = import_markers(read_marker_records(stream, input_format), batch_size)
+    return jsonify(summary), 200
+
+# --- Bulk Moderation ---
+
+MODERATION_ACTIONS = ('deactivate', 'delete', 'retype')
+
+def build_marker_filter(spec):
+    """Turns an admin marker filter into WHERE conditions and parameters.
+
+    Supported keys: bbox ('minLng,minLat,maxLng,maxLat'), marker_type, status, username,
+    created_after and created_before (ISO timestamps) and q (terms that must all match
+    title, description or contact). Raises ValueError if the filter is malformed or empty.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError('filter must be an object')
+    where, params = [], []
+    if spec.get('bbox'):
+        boxes = parse_bbox(spec['bbox'])
+        where.append('(' + ' OR '.join('(lng BETWEEN ? AND ? AND lat BETWEEN ? AND ?)' for _ in boxes) + ')')
+        for west, south, east, north in boxes:
+            params.extend([west, east, south, north])
+    for key, column in [('marker_type', 'marker_type'), ('status', 'status'), ('username', 'user_username')]:
+        if spec.get(key):
+            where.append(f'{column} = ?')
+            params.append(spec[key])
+    for key, operator in [('created_after', '>='), ('created_before', '<')]:
+        if spec.get(key):
+            created_at = parse_timestamp(spec[key]).astimezone(datetime.UTC)
+            where.append(f'created_at {operator} ?')
+            params.append(created_at.strftime('%Y-%m-%d %H:%M:%S'))
+    terms = str(spec.get('q') or '').split()
+    # Same matching as search_markers: the trigram index for terms of 3+ characters,
+    # substring filters for shorter ones
+    fts_terms = [t for t in terms if len(t) >= 3]
+    if fts_terms:
+        where.append('id IN (SELECT rowid FROM markers_fts WHERE markers_fts MATCH ?)')
+        params.append(' AND '.join('"' + t.replace('"', '""') + '"' for t in fts_terms))
+    for term in terms:
+        if len(term) < 3:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where.append("(title LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\' OR contact LIKE ? ESCAPE '\\')")
+            params.extend([pattern, pattern, pattern])
+    if not where:
+        raise ValueError('filter must have at least one condition')
+    return where, params
+
+def moderation_statement(action, new_type=None):
+    """Returns (statement, extra conditions, SET parameters, condition parameters) for a bulk action.
+
+    The extra conditions skip markers the action would not change, so they are not counted.
+    """
+    if action == 'deactivate':
+        return "UPDATE markers SET status = 'inactive'", ["status != 'inactive'"], [], []
+    if action == 'retype':
+        return 'UPDATE markers SET marker_type = ?', ['marker_type != ?'], [new_type], [new_type]
+    return 'DELETE FROM markers', [], [], []
+
+def count_moderated_markers(where, params, action, new_type=None):
+    """Returns how many markers a bulk action with this filter would change."""
+    _, extra_where, _, extra_params = moderation_statement(action, new_type)
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM markers WHERE {' AND '.join(where + extra_where)}",
+            tuple(params + extra_params)
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+def moderate_markers(where, params, action, new_type=None, chunk_size=MODERATION_CHUNK_SIZE):
+    """Applies a bulk action to the matching markers, yielding a progress dict after every chunk.
+
+    Each chunk of up to chunk_size markers (in id order) is changed by one set-based
+    statement in its own short transaction, so other writers get the lock in between.
+    Progress is also kept in bulk_transfer_stats['last_moderation']. If the caller stops
+    iterating, the chunks done so far stay applied and running the same filter again
+    picks up the rest.
+    """
+    started = time.perf_counter()
+    statement, extra_where, set_params, extra_params = moderation_statement(action, new_type)
+    where_clause = ' AND '.join(where + extra_where + ['id > ?'])
+    total = count_moderated_markers(where, params, action, new_type)
+    progress = {'action': action, 'total': total, 'processed': 0, 'chunks': 0, 'done': False}
+    bulk_transfer_stats['last_moderation'] = progress
+    last_id = 0
+    conn = get_db_connection()
+    try:
+        while True:
+            with conn:
+                rows = [dict(row) for row in conn.execute(f'''
+                    {statement}
+                    WHERE id IN (SELECT id FROM markers WHERE {where_clause} ORDER BY id LIMIT ?)
+                    RETURNING *
+                ''', tuple(set_params + params + extra_params) + (last_id, chunk_size))]
+            if not rows:
+                break
+            last_id = max(row['id'] for row in rows)
+            notify_marker_change({'delete': 'deleted', 'deactivate': 'status'}.get(action, 'updated'), rows)
+            progress['processed'] += len(rows)
+            progress['chunks'] += 1
+            progress['duration_s'] = round(time.perf_counter() - started, 3)
+            yield dict(progress)
+        progress['done'] = True
+        yield dict(progress)
+    finally:
+        conn.close()
+        progress['duration_s'] = round(time.perf_counter() - started, 3)
+        print(f"Bulk {action}: {progress['processed']} of {total} markers in {progress['duration_s']}s")
+
+@app.route('/api/admin/markers/bulk', methods=['POST'])
+@admin_required
+def admin_bulk_moderate_markers():
+    """Admin endpoint applying one action to all markers matching a filter.
+
+    Body: {'filter': {...} (see build_marker_filter), 'action': 'deactivate' | 'delete' |
+    'retype', 'marker_type': new type for retype, 'dry_run': bool, 'chunk_size': int}.
+    A dry run only returns the number of markers that would change. Otherwise the
+    progress is streamed as NDJSON, one line per chunk, ending with a 'done': true line.
+    """
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in MODERATION_ACTIONS:
+        return jsonify({'error': f"action must be one of {', '.join(MODERATION_ACTIONS)}"}), 400
+    new_type = data.get('marker_type')
+    if action == 'retype' and not new_type:
+        return jsonify({'error': 'retype requires marker_type'}), 400
+    try:
+        where, params = build_marker_filter(data.get('filter'))
+        chunk_size = int(data.get('chunk_size', MODERATION_CHUNK_SIZE))
+        if not 0 < chunk_size <= MODERATION_MAX_CHUNK_SIZE:
+            raise ValueError(f'chunk_size must be between 1 and {MODERATION_MAX_CHUNK_SIZE}')
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': f'Invalid request: {e}'}), 400
+
+    if data.get('dry_run'):
+        return jsonify({
+            'action': action,
+            'dry_run': True,
+            'matched': count_moderated_markers(where, params, action, new_type)
+        }), 200
+
+    progress = moderate_markers(where, params, action, new_type, chunk_size)
+    return Response((json.dumps(update) + '\n' for update in progress), mimetype='application/x-ndjson')
+
+# --- Archiving ---
+
+ARCHIVE_FIELDS = MARKER_EXPORT_FIELDS + ['geohash']
+archive_stats = {'runs': 0, 'last_run': None}
+
+def database_size(conn):
+    """Returns (page_size, page_count, freelist_count) of the main database."""
+    return tuple(conn.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in ('page_size', 'page_count', 'freelist_count'))
+
+def compact_database(conn, full_vacuum=False):
+    """Returns free pages to the file system and refreshes the query planner statistics.
+
+    With auto_vacuum = INCREMENTAL (the default for new databases) free pages are
+    released in steps of VACUUM_STEP_PAGES, each its own short write. Older databases
+    keep their free pages for reuse until they are converted once with full_vacuum,
+    which rewrites the whole file and blocks writers while it runs.
+    """
+    if full_vacuum:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    if auto_vacuum == 2:
+        while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+            conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+    conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+    # analysis_limit samples each index instead of reading it whole
+    conn.execute(f'PRAGMA analysis_limit = {ANALYZE_ROW_LIMIT}')
+    conn.execute('ANALYZE')
+    conn.commit()
+    return {0: 'none', 1: 'full', 2: 'incremental'}[auto_vacuum]
+
+def archive_markers(retention_days=ARCHIVE_RETENTION_DAYS, batch_size=ARCHIVE_BATCH_SIZE, full_vacuum=False):
+    """Moves markers inactive for longer than retention_days into markers_archive, then compacts the database.
+
+    A marker qualifies when it is inactive and either expired or last changed before
+    the cutoff. Batches of up to batch_size markers are copied and deleted in one
+    transaction each. Returns a report with the rows moved and the space reclaimed.
+    """
+    started = time.perf_counter()
+    cutoff = datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=retention_days)
+    columns = ', '.join(ARCHIVE_FIELDS)
+    archived = 0
+    batches = 0
+    conn = get_db_connection()
+    try:
+        page_size, pages_before, _ = database_size(conn)
+        while True:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                ids = [row[0] for row in conn.execute(
+                    ARCHIVE_CANDIDATES_QUERY, (cutoff, cutoff.strftime('%Y-%m-%d %H:%M:%S'), batch_size)
+                )]
+                if ids:
+                    placeholders = ', '.join('?' for _ in ids)
+                    conn.execute(f'''
+                        INSERT INTO markers_archive ({columns})
+                        SELECT {columns} FROM markers WHERE id IN ({placeholders})
+                    ''', ids)
+                    moved = [dict(row) for row in conn.execute(
+                        f'DELETE FROM markers WHERE id IN ({placeholders}) RETURNING *', ids
+                    )]
+            if not ids:
+                break
+            archived += len(ids)
+            batches += 1
+            notify_marker_change('deleted', moved)
+        auto_vacuum = compact_database(conn, full_vacuum)
+        _, pages_after, free_pages = database_size(conn)
+    finally:
+        conn.close()
+
+    duration = time.perf_counter() - started
+    report = {
+        'archived': archived,
+        'batches': batches,
+        'retention_days': retention_days,
+        'cutoff': cutoff.isoformat(),
+        'auto_vacuum': auto_vacuum,
+        'bytes_before': pages_before * page_size,
+        'bytes_after': pages_after * page_size,
+        'bytes_reclaimed': max(pages_before - pages_after, 0) * page_size,
+        'free_bytes': free_pages * page_size,  # Reused by later writes, reclaimed only by a full vacuum
+        'duration_s': round(duration, 3),
+    }
+    archive_stats['runs'] += 1
+    archive_stats['last_run'] = dict(report, finished_at=datetime.datetime.now(datetime.UTC).isoformat())
+    print(f"Archived {archived} markers in {duration:.2f}s, reclaimed {report['bytes_reclaimed']} bytes")
+    return report
+
+def claim_archive_run():
+    """Returns True if no process has started an archive run within the last ARCHIVE_INTERVAL seconds, and records one."""
+    now = datetime.datetime.now(datetime.UTC)
+    conn = get_db_connection()
+    with conn:
+        claimed = conn.execute('''
+            INSERT INTO app_meta (key, value) VALUES ('archive_started_at', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value WHERE value <= ?
+        ''', (now, now - datetime.timedelta(seconds=ARCHIVE_INTERVAL))).rowcount == 1
+    conn.close()
+    return claimed
+
+@app.route('/api/admin/archived-markers', methods=['GET'])
+@admin_required
+def get_archived_markers():
+    """Admin endpoint listing archived markers.
+
+    Supports the status, marker_type and username filters plus the pagination and
+    streaming parameters of admin_list_response.
+    """
+    where, params = [], []
+    for arg, column in [('status', 'a.status'), ('marker_type', 'a.marker_type'), ('username', 'a.user_username')]:
+        if request.args.get(arg):
+            where.append(f'{column} = ?')
+            params.append(request.args[arg])
+    query = '''
+        SELECT a.*, u.name as user_name
+        FROM markers_archive a
+        LEFT JOIN users u ON a.user_username = u.username
+    '''
+    return admin_list_response('markers', query, where, params, 'a.created_at DESC, a.id DESC', 'a')
+
+@app.route('/api/admin/archive', methods=['POST'])
+@admin_required
+def admin_archive_markers():
+    """Admin endpoint running the archiving job now and returning its report.
+
+    Body (optional): {'retention_days': int}, default ARCHIVE_RETENTION_DAYS.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        retention_days = int(data.get('retention_days', ARCHIVE_RETENTION_DAYS))
+        if retention_days < 0:
+            raise ValueError
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid retention_days'}), 400
+    return jsonify(archive_markers(retention_days)), 200
+
+# --- Command Line ---
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Apply pending database migrations."""
+    init_db()
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot query would do a full table scan."""
+    conn = get_db_connection()
+    full_scans = check_query_plans(conn)
+    conn.close()
+    for name, plan in full_scans.items():
+        click.echo(f"FULL SCAN in {name}: {'; '.join(plan)}", err=True)
+    if full_scans:
+        raise SystemExit(1)
+    click.echo(f"All {len(HOT_QUERIES)} hot queries use an index.")
+
+@app.cli.command('import-markers')
+@click.argument('path', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'input_format', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+def import_markers_command(path, input_format, batch_size):
+    """Import markers from an NDJSON or CSV file ('-' for stdin)."""
+    summary = import_markers(read_marker_records(path, input_format), batch_size)
+    for error in summary['errors']:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {summary['imported']} markers, rejected {summary['rejected']}, "
+               f"{summary['rows_per_second']} rows/s")
+
+@app.cli.command('export-markers')
+@click.argument('path', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'output_format', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+def export_markers_command(path, output_format):
+    """Export all markers as NDJSON or CSV to a file (default stdout)."""
+    for chunk in export_markers(output_format):
+        path.write(chunk)
+    stats = bulk_transfer_stats['last_export']
+    click.echo(f"Exported {stats['exported']} markers, {stats['rows_per_second']} rows/s", err=True)
+
+@app.cli.command('archive-markers')
+@click.option('--retention-days', default=ARCHIVE_RETENTION_DAYS, show_default=True)
+@click.option('--full-vacuum', is_flag=True, help='Rewrite the database file once to enable incremental vacuum.')
+def archive_markers_command(retention_days, full_vacuum):
+    """Move long-inactive markers to the archive and compact the database."""
+    report = archive_markers(retention_days, full_vacuum=full_vacuum)
+    click.echo(f"Archived {report['archived']} markers in {report['batches']} batches, "
+               f"reclaimed {report['bytes_reclaimed']} bytes (auto_vacuum {report['auto_vacuum']})")
+
 if __name__ == '__main__':
+    # Development server only, see gunicorn.conf.py for production serving
+    init_db()
     # Running on port 5000 to avoid conflict with the frontend server
     app.run(debug=True, port=5000) 
\ No newline at end of file
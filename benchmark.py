@@ -0,0 +1,449 @@
+"""Load test and benchmark suite for the MapConnect API.
+
+Seeds a throwaway SQLite database, drives the API endpoints through the Flask test
+client (or a real local server with --server) and reports throughput and
+p50/p95/p99 latency per route. Results can be saved as JSON and compared with an
+earlier run to catch regressions:
+
+    python benchmark.py --markers 20000 --output base.json
+    python benchmark.py --markers 20000 --server --concurrency 8 --compare base.json
+"""
+import argparse
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cities markers cluster around (lat, lng); the rest are spread uniformly
+CITIES = [
+    (39.90, 116.40), (31.23, 121.47), (22.54, 114.06), (30.57, 104.07),
+    (35.68, 139.69), (51.51, -0.13), (40.71, -74.01), (-33.87, 151.21),
+]
+MARKER_TYPES = ['personal', 'business', 'official', 'charity']
+SEARCH_TERMS = ['coffee', 'market', 'help', 'lost', 'event', 'park']
+WORDS = SEARCH_TERMS + ['open', 'today', 'free', 'near', 'station', 'shop', 'dog', 'bike', 'room', 'food']
+
+def load_app(workdir, rate_limiting=False):
+    """Imports app.py with its database and uploads inside workdir."""
+    os.chdir(workdir)  # DATABASE and UPLOAD_FOLDER are relative paths
+    sys.path.insert(0, REPO_DIR)
+    import app
+    app.RATE_LIMITING = rate_limiting  # Every benchmark request comes from one client
+    app.DATABASE = os.path.join(workdir, 'mapconnect.db')
+    app.app.config['UPLOAD_FOLDER'] = os.path.join(workdir, 'uploads', 'avatars')
+    app.db_pool.close_all()
+    app.init_db()
+    return app
+
+def seed(app, rng, users, markers, expired_fraction, cluster_fraction):
+    """Fills the database with users and markers and returns what the scenarios need."""
+    started = time.perf_counter()
+    now = datetime.datetime.now(datetime.UTC)
+    usernames = [f'user{i}' for i in range(users)]
+    conn = app.get_db_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (username, email, password, name, contact, bio) VALUES (?, ?, 'password', ?, '', '')",
+            [(name, f'{name}@example.com', f'User {i}') for i, name in enumerate(usernames)]
+        )
+        conn.execute("INSERT INTO users (username, email, password, name, role) VALUES ('admin', 'admin@example.com', 'password', 'Admin', 'admin')")
+
+    rows = []
+    for _ in range(markers):
+        if rng.random() < cluster_fraction:
+            lat, lng = rng.choice(CITIES)
+            lat = max(-85.0, min(85.0, rng.gauss(lat, 0.3)))
+            lng = max(-180.0, min(180.0, rng.gauss(lng, 0.3)))
+        else:
+            lat, lng = rng.uniform(-85, 85), rng.uniform(-180, 180)
+        visibility = rng.choice(['today', 'three_days'])
+        created_at = now - datetime.timedelta(seconds=rng.uniform(0, 30 * 86400))
+        if rng.random() < expired_fraction:
+            expires_at = now - datetime.timedelta(seconds=rng.uniform(60, 30 * 86400))
+            status = rng.choice(['active', 'inactive'])  # Some are still waiting for the sweep
+        else:
+            expires_at = now + datetime.timedelta(seconds=rng.uniform(60, 3 * 86400))
+            status = 'active' if rng.random() < 0.9 else 'inactive'
+        rows.append((
+            ' '.join(rng.choices(WORDS, k=3)), ' '.join(rng.choices(WORDS, k=12)), '', rng.choice(MARKER_TYPES),
+            visibility, lat, lng, rng.choice(usernames), created_at.strftime('%Y-%m-%d %H:%M:%S'), expires_at, status,
+            app.geohash_encode(lat, lng)
+        ))
+    with conn:
+        conn.executemany('''
+            INSERT INTO markers (title, description, contact, marker_type, visibility, lat, lng,
+                                 user_username, created_at, expires_at, status, geohash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        app.reconcile_stat_counters(conn)
+    owned = conn.execute('SELECT id, user_username FROM markers ORDER BY id').fetchall()
+    conn.close()
+    print(f'Seeded {users} users and {markers} markers in {time.perf_counter() - started:.2f}s')
+    return {'usernames': usernames, 'owned': [(row[0], row[1]) for row in owned]}
+
+def multipart(field, filename, content, content_type, boundary):
+    """Encodes one file as a multipart/form-data body, returns (body, Content-Type header)."""
+    head = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    )
+    return head.encode('utf-8') + content + f'\r\n--{boundary}--\r\n'.encode('utf-8'), f'multipart/form-data; boundary={boundary}'
+
+def build_scenarios(rng, data, requests_per_route):
+    """Returns {route: request factory}; a factory returns (method, path, headers, body).
+
+    The body is a JSON value, or raw bytes sent with the Content-Type given in headers.
+    Routes that delete rows come last so the other routes don't run into missing rows.
+    """
+    usernames = data['usernames']
+    owned = data['owned']
+    writers = iter(range(10 ** 9))
+    registrations = iter(range(10 ** 9))
+    status_sample = rng.sample(owned, min(len(owned), requests_per_route * 4))
+    status_targets = iter(status_sample)
+    remaining = sorted(set(owned) - set(status_sample))
+    delete_targets = iter(rng.sample(remaining, min(len(remaining), requests_per_route)))
+    doomed_writers = iter(reversed(data['writer_ids']))  # add_marker and add_markers_batch use them from the front
+    owned_by_user = {}
+    for marker_id, owner in owned:
+        owned_by_user.setdefault(owner, []).append(marker_id)
+    owners = sorted(owned_by_user)
+    admin = {'X-Admin-Username': 'admin'}
+
+    def viewport():
+        lat, lng = rng.choice(CITIES)
+        return f'{lng - 0.5:.4f},{lat - 0.5:.4f},{lng + 0.5:.4f},{lat + 0.5:.4f}'
+
+    def tile(z=10):
+        lat, lng = rng.choice(CITIES)
+        n = 2 ** z
+        x = int((lng + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return f'/api/tiles/{z}/{x}/{y}'
+
+    def add_marker():
+        # add_marker allows 3 active markers per user, so every request uses a fresh account
+        name = f'writer{next(writers)}'
+        lat, lng = rng.choice(CITIES)
+        return ('POST', '/api/markers', {'X-User-Username': name}, {
+            'title': 'bench', 'description': 'benchmark marker', 'marker_type': 'personal',
+            'lat': lat + rng.uniform(-0.1, 0.1), 'lng': lng + rng.uniform(-0.1, 0.1),
+            'user_username': name, 'visibility': 'today'
+        })
+
+    def add_markers_batch():
+        name = f'writer{next(writers)}'
+        markers = []
+        for _ in range(3):
+            lat, lng = rng.choice(CITIES)
+            markers.append({
+                'title': 'bench', 'description': 'benchmark marker', 'marker_type': rng.choice(MARKER_TYPES),
+                'lat': lat + rng.uniform(-0.1, 0.1), 'lng': lng + rng.uniform(-0.1, 0.1),
+                'user_username': name, 'visibility': 'today'
+            })
+        return ('POST', '/api/markers/batch', {'X-User-Username': name}, {'markers': markers})
+
+    def update_marker_status():
+        marker_id, owner = next(status_targets)
+        return ('PUT', f'/api/markers/{marker_id}/status', {'X-User-Username': owner}, {'status': 'inactive'})
+
+    def update_markers_status_batch():
+        owner = rng.choice(owners)
+        ids = owned_by_user[owner][:10]
+        return ('PUT', '/api/markers/batch/status', {'X-User-Username': owner}, {'ids': ids, 'status': 'inactive'})
+
+    def user():
+        return rng.choice(usernames)
+
+    def register_user():
+        name = f'newuser{next(registrations)}'
+        return ('POST', '/api/register', {}, {'username': name, 'email': f'{name}@example.com', 'password': 'password'})
+
+    def update_profile():
+        name = user()
+        return ('PUT', '/api/profile', {'X-User-Username': name}, {'username': name, 'bio': ' '.join(rng.choices(WORDS, k=8))})
+
+    def upload_avatar():
+        # A new color every time, so the upload is processed rather than deduplicated
+        image = io.BytesIO()
+        Image.new('RGB', (400, 300), tuple(rng.randrange(256) for _ in range(3))).save(image, 'JPEG')
+        body, content_type = multipart('avatar', 'avatar.jpg', image.getvalue(), 'image/jpeg', f'bench{rng.getrandbits(64):x}')
+        return ('POST', '/api/profile/avatar', {'X-User-Username': user(), 'Content-Type': content_type}, body)
+
+    def admin_import_markers():
+        lines = []
+        for _ in range(50):
+            lat, lng = rng.choice(CITIES)
+            lines.append(json.dumps({
+                'title': 'imported', 'description': ' '.join(rng.choices(WORDS, k=12)), 'marker_type': rng.choice(MARKER_TYPES),
+                'lat': lat + rng.uniform(-0.3, 0.3), 'lng': lng + rng.uniform(-0.3, 0.3),
+                'user_username': user(), 'visibility': 'three_days', 'status': 'inactive'
+            }))
+        return ('POST', '/api/admin/markers/import', {**admin, 'Content-Type': 'application/x-ndjson'}, '\n'.join(lines).encode('utf-8'))
+
+    def admin_bulk_moderate():
+        # Retyping keeps the number of active markers, and so the read routes, unchanged
+        lat, lng = rng.choice(CITIES)
+        bbox = f'{lng - 0.05:.4f},{lat - 0.05:.4f},{lng + 0.05:.4f},{lat + 0.05:.4f}'
+        return ('POST', '/api/admin/markers/bulk', admin, {
+            'filter': {'bbox': bbox, 'status': 'active'}, 'action': 'retype', 'marker_type': rng.choice(MARKER_TYPES)
+        })
+
+    return {
+        'get_markers': lambda: ('GET', '/api/markers', {}, None),
+        'get_markers_bbox': lambda: ('GET', f'/api/markers?bbox={viewport()}', {}, None),
+        'search_markers': lambda: ('GET', f'/api/markers/search?q={rng.choice(SEARCH_TERMS)}', {}, None),
+        'get_marker_changes': lambda: ('GET', '/api/markers/changes?since=0', {}, None),
+        'get_nearby_markers': lambda: ('GET', '/api/markers/nearby?lat={:.5f}&lng={:.5f}&radius_m=5000&k=20'.format(
+            *(lambda city: (city[0] + rng.uniform(-0.3, 0.3), city[1] + rng.uniform(-0.3, 0.3)))(rng.choice(CITIES))), {}, None),
+        'get_marker_clusters': lambda: ('GET', f'/api/markers/clusters?zoom={rng.randint(2, 10)}&bbox={viewport()}', {}, None),
+        'get_marker_tile': lambda: ('GET', tile(), {}, None),
+        'get_user_markers': lambda: ('GET', f'/api/markers/{(name := user())}', {'X-User-Username': name}, None),
+        'get_user_profile': lambda: ('GET', f'/api/users/{user()}', {}, None),
+        'login_user': lambda: ('POST', '/api/login', {}, {'username': user(), 'password': 'password'}),
+        'register_user': register_user,
+        'update_profile': update_profile,
+        'upload_avatar': upload_avatar,
+        'add_marker': add_marker,
+        'add_markers_batch': add_markers_batch,
+        'update_marker_status': update_marker_status,
+        'update_markers_status_batch': update_markers_status_batch,
+        'admin_stats': lambda: ('GET', '/api/admin/stats', admin, None),
+        'admin_all_markers': lambda: ('GET', '/api/admin/all-markers?limit=100&after=9999-12-31,0', admin, None),
+        'admin_all_users': lambda: ('GET', '/api/admin/all-users?limit=100&after=9999-12-31,0', admin, None),
+        'admin_runtime_stats': lambda: ('GET', '/api/admin/runtime-stats', admin, None),
+        'admin_update_marker': lambda: ('PUT', f'/api/admin/markers/{rng.choice(owned)[0]}', admin, {'title': 'moderated'}),
+        'admin_update_user': lambda: ('PUT', f'/api/admin/users/{rng.randint(1, len(usernames))}', admin, {'name': 'Renamed'}),
+        'admin_export_markers': lambda: ('GET', f"/api/admin/markers/export?format={rng.choice(['ndjson', 'csv'])}&marker_type={rng.choice(MARKER_TYPES)}", admin, None),
+        'admin_import_markers': admin_import_markers,
+        'admin_bulk_moderate': admin_bulk_moderate,
+        'admin_delete_marker': lambda: ('DELETE', f'/api/admin/markers/{next(delete_targets)[0]}', admin, None),
+        'admin_delete_user': lambda: ('DELETE', f'/api/admin/users/{next(doomed_writers)}', admin, None),
+    }
+
+def prepare_writers(app, count):
+    """Creates the writer accounts the write routes use up, returns their ids in order."""
+    conn = app.get_db_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (username, email, password, name) VALUES (?, ?, 'password', '')",
+            [(f'writer{i}', f'writer{i}@example.com') for i in range(count)]
+        )
+    ids = [row[0] for row in conn.execute("SELECT id FROM users WHERE username LIKE 'writer%' ORDER BY id")]
+    conn.close()
+    return ids
+
+class TestClientDriver:
+    """Sends requests through the Flask test client, one client per worker thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, path, headers, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.app.test_client()
+        if isinstance(body, bytes):
+            response = client.open(path, method=method, headers=headers, data=body)
+        else:
+            response = client.open(path, method=method, headers=headers, json=body)
+        size = len(response.get_data())  # Drains streamed bodies too
+        return response.status_code, size
+
+class ServerDriver:
+    """Serves the app from a threaded local werkzeug server and sends real HTTP requests."""
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self.server = make_server('127.0.0.1', 0, app.app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def send(self, method, path, headers, body):
+        if isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method, headers=dict(headers))
+        if data is not None and 'Content-Type' not in headers:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+    def close(self):
+        self.server.shutdown()
+
+def wait_for_avatar_jobs(app, timeout=120):
+    """Waits for queued avatar processing, so it doesn't slow down the next route."""
+    deadline = time.monotonic() + timeout
+    while app.avatar_jobs.pending and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def run_route(driver, factory, requests, concurrency, warmup):
+    for _ in range(warmup):
+        driver.send(*factory())
+    # Build the requests up front so the random generator isn't shared between threads
+    planned = [factory() for _ in range(requests)]
+    latencies = []
+    statuses = {}
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def one(spec):
+        nonlocal total_bytes
+        started = time.perf_counter()
+        status, size = driver.send(*spec)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+            total_bytes += size
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(one, planned))
+    else:
+        for spec in planned:
+            one(spec)
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'status_codes': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': round(requests / duration, 1) if duration > 0 else None,
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'mean_bytes': round(total_bytes / requests),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """Returns the routes whose p95 latency or throughput got worse than threshold allows."""
+    regressions = []
+    for route, current in results['routes'].items():
+        previous = baseline.get('routes', {}).get(route)
+        if not previous:
+            continue
+        if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append(f"{route}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if previous['throughput_rps'] and current['throughput_rps'] < previous['throughput_rps'] / (1 + threshold):
+            regressions.append(f"{route}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--markers', type=int, default=10000)
+    parser.add_argument('--expired-fraction', type=float, default=0.3, help='share of markers already past expires_at')
+    parser.add_argument('--cluster-fraction', type=float, default=0.8, help='share of markers placed around cities')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--server', action='store_true', help='benchmark a real local HTTP server instead of the test client')
+    parser.add_argument('--rate-limits', action='store_true', help='keep the per-client rate limits enabled')
+    parser.add_argument('--routes', help='comma-separated subset of routes to run')
+    parser.add_argument('--seed', type=int, default=42, help='random seed, for reproducible data and requests')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='baseline results JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown before a route counts as regressed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix='mapconnect-bench-') as workdir:
+        app = load_app(workdir, args.rate_limits)
+        data = seed(app, rng, args.users, args.markers, args.expired_fraction, args.cluster_fraction)
+        # add_marker and add_markers_batch each use up one writer per request, admin_delete_user deletes one
+        data['writer_ids'] = prepare_writers(app, 3 * (args.requests + args.warmup))
+        scenarios = build_scenarios(rng, data, args.requests + args.warmup)
+        # Accept every upload, upload_avatar measures the processing pipeline rather than load shedding
+        app.avatar_jobs.max_pending = max(app.avatar_jobs.max_pending, args.requests + args.warmup)
+        if args.routes:
+            unknown = set(args.routes.split(',')) - set(scenarios)
+            if unknown:
+                parser.error(f"unknown routes: {', '.join(sorted(unknown))}")
+            scenarios = {name: scenarios[name] for name in args.routes.split(',')}
+
+        driver = ServerDriver(app) if args.server else TestClientDriver(app)
+        results = {
+            'commit': git_commit(),
+            'started_at': datetime.datetime.now(datetime.UTC).isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+            'routes': {},
+        }
+        print(f"{'route':<30}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+        try:
+            for name, factory in scenarios.items():
+                stats = run_route(driver, factory, args.requests, args.concurrency, args.warmup)
+                results['routes'][name] = stats
+                wait_for_avatar_jobs(app)
+                print(f"{name:<30}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+                      f"{stats['p99_ms']:>10}{stats['errors']:>8}")
+        finally:
+            if args.server:
+                driver.close()
+            app.db_pool.close_all()
+            os.chdir(REPO_DIR)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        changed = [k for k, v in results['config'].items() if baseline.get('config', {}).get(k) != v and k != 'threshold']
+        if changed:
+            print(f"Warning: baseline was run with different settings ({', '.join(changed)})")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions against {args.compare} (commit {baseline.get('commit')}):")
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (commit {baseline.get('commit')})")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""Gunicorn configuration for serving the MapConnect API in production.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be overridden with the MAPCONNECT_* environment variables below.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+
+bind = os.environ.get('MAPCONNECT_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('MAPCONNECT_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# gthread serves each worker's requests from a thread pool. Install gevent and set
+# MAPCONNECT_WORKER_CLASS=gevent to hold thousands of live streams per worker.
+worker_class = os.environ.get('MAPCONNECT_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('MAPCONNECT_THREADS', 16))
+worker_connections = int(os.environ.get('MAPCONNECT_WORKER_CONNECTIONS', 1000))  # gevent only
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+
+# The app reads these when a worker imports it
+if worker_class == 'gthread':
+    # Each live stream holds a thread until the client leaves, keep half of them for regular requests
+    os.environ.setdefault('MAPCONNECT_STREAM_MAX_SUBSCRIBERS', str(max(1, threads // 2)))
+if workers > 1:
+    # Workers keep their caches and live streams in sync through the change log
+    os.environ.setdefault('MAPCONNECT_FOLLOW_CHANGES', '1')
+
+def on_starting(server):
+    """Applies database migrations once per deployment, before any worker starts.
+
+    This runs in a separate process so the master never imports the app: workers
+    must not inherit its connections, threads or (for gevent) unpatched locks.
+    """
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], check=True, cwd=server.cfg.chdir)
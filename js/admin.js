@@ -212,8 +212,9 @@ const Admin = {
             const row = document.createElement('tr');
             row.dataset.id = user.id;
             row.dataset.username = user.username;
+            // 列表缩略图使用最小尺寸的头像（旧头像没有缩略图，仍用原图）
             const avatar = user.avatar_url 
-                ? `<img src="${user.avatar_url}" class="table-avatar" alt="${user.username}">` 
+                ? `<img src="${user.avatar_url.replace(/_(64|200|800)\.jpg$/, '_64.jpg')}" class="table-avatar" alt="${user.username}">` 
                 : `<div class="table-avatar-initial">${user.username.charAt(0).toUpperCase()}</div>`;
             row.innerHTML = `
                 <td>#${user.id}</td>
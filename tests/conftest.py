@@ -0,0 +1,28 @@
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """A freshly imported app with an initialized database in tmp_path and the user 'alice'."""
+    monkeypatch.chdir(tmp_path)  # DATABASE and UPLOAD_FOLDER are relative to the working directory
+    sys.modules.pop('app', None)
+    module = importlib.import_module('app')
+    module.init_db()
+    module.RATE_LIMITING = False
+    conn = module.get_db_connection()
+    with conn:
+        conn.execute("INSERT INTO users (username, email, password) VALUES ('alice', 'alice@example.com', 'x')")
+    conn.close()
+    yield module
+    sys.modules.pop('app', None)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,91 @@
+import io
+from concurrent.futures import Future
+
+import pytest
+from PIL import Image
+
+
+class DeferredExecutor:
+    """Stands in for the process pool: jobs only finish when the test says so."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.submitted.append((future, fn, args))
+        return future
+
+    def finish(self, index):
+        future, fn, args = self.submitted[index]
+        future.set_result(fn(*args))
+
+
+@pytest.fixture
+def executor(app_module):
+    executor = DeferredExecutor()
+    app_module.avatar_jobs._executor = executor
+    return executor
+
+
+def upload(client, color):
+    image = io.BytesIO()
+    Image.new('RGB', (300, 200), color).save(image, 'JPEG')
+    image.seek(0)
+    return client.post(
+        '/api/profile/avatar', data={'avatar': (image, 'a.jpg')},
+        headers={'X-User-Username': 'alice'}, content_type='multipart/form-data'
+    )
+
+
+def job_status(client, response):
+    return client.get(response.json['status_url'], headers={'X-User-Username': 'alice'}).json['status']
+
+
+def current_avatar(app_module):
+    conn = app_module.get_db_connection()
+    avatar_url = conn.execute("SELECT avatar_url FROM users WHERE username = 'alice'").fetchone()[0]
+    conn.close()
+    return avatar_url
+
+
+def test_older_job_finishing_last_is_superseded(app_module, client, executor):
+    first = upload(client, (10, 20, 30))
+    second = upload(client, (200, 0, 0))
+    assert first.status_code == second.status_code == 202
+
+    executor.finish(1)
+    executor.finish(0)
+
+    assert job_status(client, second) == 'done'
+    assert job_status(client, first) == 'superseded'
+    assert current_avatar(app_module) == second.json['avatar_url']
+    assert app_module.avatar_files_exist(second.json['avatar_url'])
+
+
+def test_rejected_upload_does_not_supersede_accepted_job(app_module, client, executor):
+    app_module.avatar_jobs.max_pending = 1
+    accepted = upload(client, (10, 20, 30))
+    rejected = upload(client, (200, 0, 0))
+    assert accepted.status_code == 202
+    assert rejected.status_code == 503
+
+    executor.finish(0)
+
+    assert job_status(client, accepted) == 'done'
+    assert current_avatar(app_module) == accepted.json['avatar_url']
+
+
+def test_collection_skips_files_of_a_job_still_in_flight(app_module, client, executor):
+    response = upload(client, (10, 20, 30))
+    avatar_url = response.json['avatar_url']
+    future, fn, args = executor.submitted[0]
+    result = fn(*args)  # The worker has written the files but the job has not been applied yet
+
+    app_module.collect_avatar_files(avatar_url)
+    assert app_module.avatar_files_exist(avatar_url)
+
+    future.set_result(result)
+    assert job_status(client, response) == 'done'
+    assert current_avatar(app_module) == avatar_url
+    assert not app_module.avatar_jobs.is_in_flight(avatar_url)
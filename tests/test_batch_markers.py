@@ -0,0 +1,61 @@
+ALICE = {'X-User-Username': 'alice'}
+
+
+def create_markers(client, count):
+    markers = [{
+        'title': f'marker {i}', 'description': 'd', 'marker_type': 'place', 'lat': 10, 'lng': 10 + i,
+        'user_username': 'alice', 'visibility': 'three_days'
+    } for i in range(count)]
+    response = client.post('/api/markers/batch', json={'markers': markers}, headers=ALICE)
+    assert response.status_code == 201, response.json
+    return [result['id'] for result in response.json['results']]
+
+
+def set_status(client, ids, status):
+    return client.put('/api/markers/batch/status', json={'ids': ids, 'status': status}, headers=ALICE)
+
+
+def active_count(app_module):
+    conn = app_module.get_db_connection()
+    count = conn.execute("SELECT COUNT(*) FROM markers WHERE user_username = 'alice' AND status = 'active'").fetchone()[0]
+    conn.close()
+    return count
+
+
+def test_batch_activation_stops_at_the_active_marker_limit(app_module, client):
+    inactive = create_markers(client, 3)
+    assert set_status(client, inactive, 'inactive').json['updated'] == 3
+    create_markers(client, 2)
+
+    response = set_status(client, inactive, 'active')
+
+    assert response.status_code == 200
+    assert response.json['updated'] == 1
+    results = response.json['results']
+    assert results[0] == {'id': inactive[0], 'status': 'active'}
+    assert [result['id'] for result in results[1:]] == inactive[1:]
+    assert all('maximum limit' in result['error'] for result in results[1:])
+    assert active_count(app_module) == app_module.MAX_ACTIVE_MARKERS_PER_USER
+
+
+def test_batch_activation_of_already_active_markers_is_not_limited(app_module, client):
+    active = create_markers(client, 3)
+
+    response = set_status(client, active, 'active')
+
+    assert response.json['updated'] == 3
+    assert all(result['status'] == 'active' for result in response.json['results'])
+    assert active_count(app_module) == 3
+
+
+def test_batch_create_over_the_limit_creates_nothing(app_module, client):
+    create_markers(client, 2)
+    markers = [{
+        'title': 'x', 'description': 'd', 'marker_type': 'place', 'lat': 0, 'lng': i,
+        'user_username': 'alice', 'visibility': 'today'
+    } for i in range(2)]
+
+    response = client.post('/api/markers/batch', json={'markers': markers}, headers=ALICE)
+
+    assert response.status_code == 403
+    assert active_count(app_module) == 2
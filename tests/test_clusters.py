@@ -0,0 +1,29 @@
+import pytest
+
+
+def add_marker(client, lat, lng, marker_type='place'):
+    response = client.post('/api/markers', json={
+        'title': 'x', 'description': 'd', 'marker_type': marker_type, 'lat': lat, 'lng': lng,
+        'user_username': 'alice', 'visibility': 'three_days'
+    }, headers={'X-User-Username': 'alice'})
+    assert response.status_code == 201, response.json
+
+
+@pytest.mark.parametrize('zoom', [0, 1, 3])
+def test_antimeridian_split_bbox_counts_each_marker_once(client, zoom):
+    add_marker(client, 10, 45)
+
+    clusters = client.get(f'/api/markers/clusters?bbox=10,-80,5,80&zoom={zoom}').json['clusters']
+
+    assert sum(cluster['count'] for cluster in clusters) == 1
+    assert [cluster['types'] for cluster in clusters] == [{'place': 1}]
+
+
+def test_bbox_up_to_the_antimeridian_is_clamped_to_the_last_cell(client):
+    add_marker(client, 10, 179.9)
+    add_marker(client, 10, -179.9)
+
+    clusters = client.get('/api/markers/clusters?bbox=170,0,-170,20&zoom=0').json['clusters']
+
+    assert sorted(cluster['cell'][0] for cluster in clusters) == [0, 3]
+    assert sum(cluster['count'] for cluster in clusters) == 2
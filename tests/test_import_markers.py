@@ -0,0 +1,17 @@
+import datetime
+
+
+def test_import_converts_offsets_to_utc(app_module):
+    record = {
+        'title': 't', 'description': 'd', 'marker_type': 'help', 'lat': 30, 'lng': 120,
+        'user_username': 'alice', 'visibility': 'three_days', 'status': 'active',
+        'created_at': '2026-10-18T08:00:00+08:00', 'expires_at': '2099-01-01T08:00:00+08:00',
+    }
+    summary = app_module.import_markers(iter([(1, record)]))
+    assert summary['imported'] == 1
+
+    conn = app_module.get_db_connection()
+    row = conn.execute('SELECT created_at, expires_at FROM markers').fetchone()
+    conn.close()
+    assert row['created_at'] == '2026-10-18 00:00:00'
+    assert row['expires_at'] == str(datetime.datetime(2099, 1, 1, tzinfo=datetime.UTC))
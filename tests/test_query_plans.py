@@ -0,0 +1,12 @@
+def test_hot_queries_use_an_index(app_module):
+    conn = app_module.get_db_connection()
+    try:
+        assert app_module.check_query_plans(conn) == {}
+    finally:
+        conn.close()
+
+
+def test_every_search_shape_is_checked(app_module):
+    for name in ['search_markers', 'search_markers_by_type', 'search_markers_short_terms', 'search_markers_short_terms_by_type']:
+        assert name in app_module.HOT_QUERIES
+        assert f'{name}_count' in app_module.HOT_QUERIES
@@ -0,0 +1,22 @@
+import pytest
+
+
+def register(client, username):
+    return client.post('/api/register', json={'username': username, 'email': f'{username}@example.com', 'password': 'p'})
+
+
+@pytest.mark.parametrize('username', ['search', 'changes', 'clusters', 'nearby', 'stream'])
+def test_names_of_fixed_marker_routes_are_reserved(client, username):
+    response = register(client, username)
+
+    assert response.status_code == 400
+    assert response.json['error'] == 'This username is reserved'
+
+
+def test_registered_user_can_list_their_markers(client):
+    assert register(client, 'batch').status_code == 201  # /api/markers/batch only takes POST
+
+    response = client.get('/api/markers/batch', headers={'X-User-Username': 'batch'})
+
+    assert response.status_code == 200
+    assert response.json == []